@@ -1,37 +1,427 @@
 #!/usr/bin/env python
 import argparse
-import subprocess
 import types
 import sys
 import os
+import fnmatch
+import errno
+import hashlib
+import sqlite3
+import threading
+import Queue
+import multiprocessing
+
+class DpkgDB:
+    # reads the dpkg admin dir (status and info/*.list) in process
+    # instead of forking a dpkg-query per question
+    def __init__(self,admindir='/var/lib/dpkg'):
+        self.admindir = admindir
+        self.nativearch = None
+        self.diversions = None
+
+    def getStanzas(self):
+        # yields the lines of each stanza of the status file
+        lines = []
+        with open(self.admindir + '/status') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line == '':
+                    if len(lines) > 0:
+                        yield lines
+                        lines = []
+                    continue
+                lines.append(line)
+        if len(lines) > 0:
+            yield lines
+
+    def parseStanza(self,lines):
+        fields = dict()
+        key = None
+        for line in lines:
+            if line[0] in ' \t':
+                if key != None:
+                    fields[key] += '\n' + line
+                continue
+            key, sep, value = line.partition(':')
+            key = key.strip()
+            fields[key] = value.strip()
+        return fields
+
+    def getNativeArch(self):
+        # the arch of dpkg itself , without running dpkg --print-architecture
+        if self.nativearch == None:
+            self.nativearch = ''
+            for lines in self.getStanzas():
+                if lines[0] == 'Package: dpkg':
+                    self.nativearch = self.parseStanza(lines).get('Architecture','')
+                    break
+        return self.nativearch
+
+    def getName(self,fields):
+        # name:arch for multi-arch same and foreign pkgs , like dpkg does
+        name = fields.get('Package','')
+        arch = fields.get('Architecture','')
+        if fields.get('Multi-Arch') == 'same' or arch not in ['all', self.getNativeArch()]:
+            return name + ':' + arch
+        return name
+
+    def getPackages(self,patterns=None):
+        # yields (name, fields, lines) for every selected pkg , in status
+        # file order . patterns are globs on the name like dpkg's
+        for lines in self.getStanzas():
+            fields = self.parseStanza(lines)
+            if fields.get('Status','').split(' ')[0] not in ['install','hold']:
+                continue
+            name = self.getName(fields)
+            if patterns and not [p for p in patterns if fnmatch.fnmatchcase(fields['Package'],p) or fnmatch.fnmatchcase(name,p)]:
+                continue
+            yield name, fields, lines
+
+    def getInfoFile(self,name,ext):
+        # info/name:arch.ext for multi-arch same pkgs , else info/name.ext
+        infofile = '%s/info/%s.%s' % (self.admindir,name,ext)
+        if ':' in name and not os.path.exists(infofile):
+            infofile = '%s/info/%s.%s' % (self.admindir,name.split(':')[0],ext)
+        return infofile
+
+    def getListFile(self,name):
+        return self.getInfoFile(name,'list')
+
+    def getMd5sums(self,name):
+        # yields (path, md5) of the files a pkg shipped
+        try:
+            with open(self.getInfoFile(name,'md5sums')) as f:
+                for line in f:
+                    md5, sep, path = line.rstrip('\n').partition(' ')
+                    if sep:
+                        yield '/' + path.lstrip(' *'), md5
+        except IOError:
+            return
+
+    def getDiversions(self):
+        # divert-from -> (divert-to, pkg) , pkg is ':' for local diversions
+        if self.diversions == None:
+            self.diversions = dict()
+            try:
+                with open(self.admindir + '/diversions') as f:
+                    lines = [line.rstrip('\n') for line in f]
+            except IOError:
+                lines = []
+            for n in range(0, len(lines) - 2, 3):
+                self.diversions[lines[n]] = (lines[n+1], lines[n+2])
+        return self.diversions
+
+    def getFiles(self,name):
+        # yields the paths a pkg installed , with dpkg -L's diversion notes
+        diversions = self.getDiversions()
+        try:
+            with open(self.getListFile(name)) as f:
+                for line in f:
+                    path = line.rstrip('\n')
+                    yield path
+                    if path in diversions:
+                        divertto, diverter = diversions[path]
+                        if diverter == name.split(':')[0]:
+                            yield 'package diverts others to: ' + divertto
+                        elif diverter == ':':
+                            yield 'locally diverted to: ' + divertto
+                        else:
+                            yield 'diverted by %s to: %s' % (diverter, divertto)
+        except IOError:
+            return
+
+    def getOwners(self,path):
+        # names of the pkgs whose list has path , one pass over info/*.list
+        path = os.path.normpath(path)
+        infodir = self.admindir + '/info'
+        owners = []
+        for listfile in sorted(os.listdir(infodir)):
+            if not listfile.endswith('.list'):
+                continue
+            with open(infodir + '/' + listfile) as f:
+                for line in f:
+                    if line.rstrip('\n') == path:
+                        owners.append(listfile[:-len('.list')])
+                        break
+        return owners
+
+class OwnerIndex:
+    # path -> pkgs , kept in sqlite next to the user's other caches and
+    # refreshed from only the .list files whose mtime or size changed
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS lists (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT NOT NULL,
+            list INTEGER NOT NULL,
+            PRIMARY KEY (path, list)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS files_list ON files (list);
+    """
+
+    def __init__(self,db,indexfile):
+        self.db = db
+        self.indexfile = indexfile
+        if not os.path.isdir(os.path.dirname(indexfile)):
+            os.makedirs(os.path.dirname(indexfile))
+        self.conn = sqlite3.connect(indexfile)
+        self.conn.text_factory = str
+        self.conn.executescript(self.SCHEMA)
+        self.fresh = False
+
+    def refresh(self):
+        # one stat per .list , and a reread of just the ones that changed
+        if self.fresh:
+            return
+        infodir = self.db.admindir + '/info'
+        current = dict()
+        for listfile in os.listdir(infodir):
+            if listfile.endswith('.list'):
+                st = os.stat(infodir + '/' + listfile)
+                current[listfile[:-len('.list')]] = (st.st_mtime, st.st_size)
+
+        known = dict([(name, (id, mtime, size)) for id, name, mtime, size in
+                      self.conn.execute("SELECT id, name, mtime, size FROM lists")])
+        with self.conn:
+            for name, (id, mtime, size) in known.items():
+                if current.get(name) != (mtime, size):
+                    self.conn.execute("DELETE FROM files WHERE list = ?", (id,))
+                    self.conn.execute("DELETE FROM lists WHERE id = ?", (id,))
+            for name, (mtime, size) in current.items():
+                if name in known and known[name][1:] == (mtime, size):
+                    continue
+                id = self.conn.execute("INSERT INTO lists (name, mtime, size) VALUES (?,?,?)", (name, mtime, size)).lastrowid
+                with open('%s/%s.list' % (infodir, name)) as f:
+                    self.conn.executemany("INSERT OR IGNORE INTO files (path, list) VALUES (?,?)",
+                                          ((line.rstrip('\n'), id) for line in f))
+        self.fresh = True
+
+    def getOwners(self,path):
+        self.refresh()
+        rows = self.conn.execute("SELECT lists.name FROM files JOIN lists ON files.list = lists.id "
+                                 "WHERE files.path = ? ORDER BY lists.name", (os.path.normpath(path),))
+        return [row[0] for row in rows]
+
+class Verifier:
+    # checks installed files against info/<pkg>.md5sums on a pool of
+    # threads (hashlib lets go of the GIL) . files that verified clean are
+    # remembered with their size , mtime and ctime and skipped next time
+    # while those are unchanged
+    CHUNKSIZE = 256 * 1024
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS verified (
+            path TEXT PRIMARY KEY,
+            md5 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            ctime REAL NOT NULL
+        );
+    """
+
+    def __init__(self,db,cachefile,threads,root='/'):
+        self.db = db
+        self.cachefile = cachefile
+        self.threads = threads
+        self.root = root
+        self.counts = dict()
+
+    def loadCache(self):
+        if not os.path.isdir(os.path.dirname(self.cachefile)):
+            os.makedirs(os.path.dirname(self.cachefile))
+        self.conn = sqlite3.connect(self.cachefile)
+        self.conn.text_factory = str
+        self.conn.executescript(self.SCHEMA)
+        return dict([(row[0], row[1:]) for row in self.conn.execute("SELECT path, md5, size, mtime, ctime FROM verified")])
+
+    def getJobs(self,pkgs):
+        # (pkg, path as shipped , path on disk , md5)
+        diversions = self.db.getDiversions()
+        for name, fields, lines in self.db.getPackages(pkgs):
+            for path, md5 in self.db.getMd5sums(name):
+                diskpath = path
+                if path in diversions and diversions[path][1] != name.split(':')[0]:
+                    # someone else's file is there , ours was moved
+                    diskpath = diversions[path][0]
+                yield name, path, os.path.join(self.root, diskpath.lstrip('/')), md5
+
+    def check(self,job,cache):
+        # (status , job , cache row for OK or the error for ERROR)
+        name, path, diskpath, md5 = job
+        try:
+            st = os.stat(diskpath)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return ('MISSING', job, None)
+            return ('ERROR', job, e.strerror)
+        row = (md5, st.st_size, st.st_mtime, st.st_ctime)
+        if cache.get(diskpath) == row:
+            return ('SKIPPED', job, None)
+        digest = hashlib.md5()
+        try:
+            with open(diskpath,'rb') as f:
+                for data in iter(lambda: f.read(self.CHUNKSIZE), ''):
+                    digest.update(data)
+        except IOError as e:
+            return ('ERROR', job, e.strerror)
+        if digest.hexdigest() != md5:
+            return ('FAILED', job, None)
+        return ('OK', job, row)
+
+    def worker(self,jobs,results,cache):
+        # polls , so it notices a stop even when no job or end marker comes
+        while not self.stopped.is_set():
+            try:
+                job = jobs.get(True,0.1)
+            except Queue.Empty:
+                continue
+            if job == None:
+                break
+            results.put(self.check(job,cache))
+
+    def put(self,jobs,job):
+        # gives up once stopped , nobody may be taking jobs any more
+        while not self.stopped.is_set():
+            try:
+                jobs.put(job,True,0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def feed(self,jobs,pkgs):
+        for job in self.getJobs(pkgs):
+            if not self.put(jobs,job):
+                return
+        for n in range(self.threads):
+            self.put(jobs,None)
+
+    def run(self,pkgs=None,verbose=False):
+        # yields a line per problem as soon as it is found
+        cache = self.loadCache()
+        self.stopped = threading.Event()
+        jobs = Queue.Queue(self.threads * 64)
+        results = Queue.Queue()
+        threads = [threading.Thread(target=self.worker,args=(jobs,results,cache)) for n in range(self.threads)]
+        threads.append(threading.Thread(target=self.feed,args=(jobs,pkgs)))
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        clean = []
+        dirty = []
+        self.counts = dict()
+        try:
+            while True:
+                try:
+                    status, (name, path, diskpath, md5), detail = results.get(True,0.1)
+                except Queue.Empty:
+                    if not [t for t in threads if t.is_alive()] and results.empty():
+                        break
+                    continue
+                self.counts[status] = self.counts.get(status,0) + 1
+                if status == 'OK':
+                    clean.append((diskpath,) + detail)
+                elif status != 'SKIPPED':
+                    dirty.append((diskpath,))
+                if status == 'ERROR':
+                    yield '%-8s %s\t%s : %s' % (status, name, path, detail)
+                elif status not in ['OK','SKIPPED'] or verbose:
+                    yield '%-8s %s\t%s' % (status, name, path)
+        finally:
+            # also when the reader went away , keep what was checked so far
+            self.stopped.set()
+            for t in threads:
+                t.join()
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO verified VALUES (?,?,?,?,?)", clean)
+                self.conn.executemany("DELETE FROM verified WHERE path = ?", dirty)
+            self.conn.close()
 
-'''
-'''
 class Pkg:
-    def __init__(self):
+    def __init__(self,admindir='/var/lib/dpkg',indexfile=None):
         self.verbose = False
-        pass;
+        self.db = DpkgDB(admindir)
+        self.indexfile = indexfile
+        self.owners = None
+
+    def getCacheFile(self,prefix):
+        # one file per admin dir , under the user's cache dir
+        cachedir = os.environ.get('XDG_CACHE_HOME',os.path.expanduser('~/.cache'))
+        key = hashlib.md5(os.path.abspath(self.db.admindir)).hexdigest()[:12]
+        return '%s/pkg/%s-%s.db' % (cachedir, prefix, key)
+
+    def getIndexFile(self):
+        if self.indexfile != None:
+            return self.indexfile
+        return self.getCacheFile('owners')
+
+    def getOwnerIndex(self):
+        # None when the index can not be used , the lists are scanned then
+        if self.owners == None:
+            try:
+                self.owners = OwnerIndex(self.db,self.getIndexFile())
+                self.owners.refresh()
+            except (IOError, OSError, sqlite3.Error) as e:
+                sys.stderr.write('not using the owner index : %s\n' % (e))
+                self.owners = False
+        return self.owners if self.owners != False else None
 
     def getPackageList(self,pkgs=None):
-        cmd=['dpkg', '--get-selections']
-        cmd.extend(self.getAsList(pkgs))
-        lines=self.getCmdOutput(cmd)
-        return [line.split('\t')[0] for line in lines if -1==line.find('deinstall')]
+        for name, fields, lines in self.db.getPackages(self.getAsList(pkgs)):
+            yield name
 
     def getPackageFiles(self,pkgname):
-        cmd= ['dpkg-query', '-L']
-        cmd.extend(self.getAsList(pkgname))
-        return self.getCmdOutput(cmd)
-    
+        for name in self.getAsList(pkgname):
+            for path in self.db.getFiles(name):
+                yield path
+
+    def getAllFiles(self,pkgs=None):
+        # pkg:\tfile for every file of every matching pkg , in one pass
+        for name, fields, lines in self.db.getPackages(self.getAsList(pkgs)):
+            for path in self.db.getFiles(name):
+                yield name + ':\t' + path
+
     def getOwner(self,files):
-        cmd= ['dpkg', '-S']
-        cmd.extend(self.getAsList(files))
-        return self.getCmdOutput(cmd)                   
+        # files may be any iterable , eg stdin in batch mode
+        index = self.getOwnerIndex()
+        for path in (self.getAsList(files) if type(files) in [types.ListType,types.StringType] else files):
+            path = path.rstrip('\n')
+            if len(path) == 0:
+                continue
+            owners = index.getOwners(path) if index != None else self.db.getOwners(path)
+            if len(owners) == 0:
+                sys.stderr.write('no pkg owns %s\n' % (path))
+                continue
+            yield '%s: %s' % (', '.join(owners), path)
 
     def getPackageInfo(self,pkgs):
-        cmd= ['dpkg', '-p']
-        cmd.extend(self.getAsList(pkgs))
-        return self.getCmdOutput(cmd)
+        # the status stanzas of the pkgs
+        found = set()
+        for name, fields, lines in self.db.getPackages(self.getAsList(pkgs)):
+            found.add(fields['Package'])
+            for line in lines:
+                yield line
+            yield ''
+        for pattern in self.getAsList(pkgs):
+            if not fnmatch.filter(found,pattern.split(':')[0]):
+                sys.stderr.write('package %s is not installed\n' % (pattern))
+
+    def verify(self,pkgs=None,threads=None,root='/'):
+        # FAILED / MISSING / ERROR lines as they are found , then a summary
+        if threads == None:
+            threads = multiprocessing.cpu_count() * 2
+        verifier = Verifier(self.db,self.getCacheFile('verified'),threads,root)
+        for line in verifier.run(self.getAsList(pkgs),self.verbose):
+            yield line
+        counts = verifier.counts
+        sys.stderr.write('checked %d files (%d unchanged since their last clean check) : %d failed , %d missing , %d unreadable\n' %
+                         (sum(counts.values()), counts.get('SKIPPED',0), counts.get('FAILED',0),
+                          counts.get('MISSING',0), counts.get('ERROR',0)))
+        self.problems = counts.get('FAILED',0) + counts.get('MISSING',0) + counts.get('ERROR',0)
 
     def getAsList(self,data):
         if type(data)==types.ListType:
@@ -40,12 +430,6 @@ class Pkg:
             return [data]
         return []
 
-    def getCmdOutput(self,cmd):
-        if self.verbose:
-            print cmd
-        p1=subprocess.Popen(cmd,stdout=subprocess.PIPE)
-        return [line.strip('\n') for line in p1.stdout]
-
     def printLines(self,lines):
         for line in lines:
             print line
@@ -53,17 +437,20 @@ class Pkg:
 
 def usage():
     return '''
-%(prog)s cmd [options] [[pkgname]...] [file] [program-options]
+%(prog)s cmd [options] [[pkgname]...] [file]
    cmd :-
        ls    : list packages
        info  : display pkg information
        help  : display this menu
-       which : show which pkg contains the file
+       which : show which pkg contains the file , - reads the files from stdin
+       verify: check the installed files of the pkgs (or all) against their md5sums
    options :-
        --files  : for ls , list files in the pkg
        [file]   : for ls , if a file is specified, it will print the pkg that owns it
-   program-options:
-             : all these will be sent to the subprocess
+       --admindir dir : dpkg database to read [/var/lib/dpkg]
+       --index file   : for which , the file to pkg index [~/.cache/pkg/owners-*.db]
+       -j n           : for verify , files hashed in parallel [2 x cpus]
+       --root dir     : for verify , where the pkgs are installed [/]
 '''
 
 if __name__ == "__main__":
@@ -75,6 +462,10 @@ if __name__ == "__main__":
     #parser.add_argument('cmd',default='help' ,help='ls,info,which,help',nargs='?' )
     parser.add_argument('-f','--files', action="store_true")
     parser.add_argument('-v','--verbose', action="store_true")
+    parser.add_argument('--admindir', default=os.environ.get('DPKG_ADMINDIR','/var/lib/dpkg'))
+    parser.add_argument('--index', default=None)
+    parser.add_argument('-j','--jobs', type=int, default=None)
+    parser.add_argument('--root', default='/')
     parser.add_argument('other', nargs=argparse.REMAINDER)
 
     cmd='help'
@@ -89,6 +480,10 @@ if __name__ == "__main__":
         cmd='list'
     elif args.cmd=='info':
         cmd='info'
+    elif args.cmd=='which':
+        cmd='which'
+    elif args.cmd=='verify':
+        cmd='verify'
     
     #print args;
 
@@ -96,13 +491,11 @@ if __name__ == "__main__":
 	parser.print_usage()
     else:
         try :
-            pkg=Pkg()
+            pkg=Pkg(args.admindir,args.index)
             pkg.verbose = args.verbose
             if cmd == 'list':
                 if args.files :
-                    pkglist=pkg.getPackageList(args.other)
-                    for p in pkglist:
-                        pkg.printLines([ p + ':\t' + f  for f in pkg.getPackageFiles(p)])
+                    pkg.printLines(pkg.getAllFiles(args.other))
                 else:
                     # check if the arg is a file or pkgname
                     if len(args.other)==1 and args.other[0].startswith('/'):
@@ -115,5 +508,22 @@ if __name__ == "__main__":
 
             elif cmd=='info':
                 pkg.printLines(pkg.getPackageInfo(args.other))
+
+            elif cmd=='which':
+                if args.other == ['-']:
+                    # batch mode , one path per line
+                    pkg.printLines(pkg.getOwner(sys.stdin))
+                else:
+                    pkg.printLines(pkg.getOwner(args.other))
+
+            elif cmd=='verify':
+                pkg.printLines(pkg.verify(args.other,args.jobs,args.root))
+                if pkg.problems > 0:
+                    sys.exit(1)
         except KeyboardInterrupt:
             pass;
+        except IOError as e:
+            # eg a closed pipe when piped into head
+            if e.errno != errno.EPIPE:
+                print 'error: %s' % (e)
+                sys.exit(1)
@@ -0,0 +1,340 @@
+#!/usr/bin/python
+import os
+import sys
+import time
+import json
+import shutil
+import signal
+import socket
+import tarfile
+import tempfile
+import argparse
+import logging
+import threading
+import subprocess
+import httplib
+from collections import OrderedDict
+from cStringIO import StringIO
+
+from pkgrepo import PackageRepo
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('pkgbench')
+
+def arMember(name,data):
+    # common ar format header , members padded to an even size
+    header = "%-16s%-12d%-6d%-6d%-8s%-10d`\n" % (name, int(time.time()), 0, 0, '100644', len(data))
+    return header + data + ('\n' if len(data) % 2 else '')
+
+def tarGz(files):
+    # files is a list of (name, data)
+    out = StringIO()
+    tar = tarfile.open(fileobj=out, mode='w:gz')
+    for name, data in files:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0644
+        tar.addfile(info, StringIO(data))
+    tar.close()
+    return out.getvalue()
+
+def makeDeb(path,name,version,arch,size):
+    # a small but valid .deb with size bytes of incompressible payload
+    control = "Package: %s\nVersion: %s\nArchitecture: %s\nMaintainer: bench <bench@localhost>\n" \
+              "Installed-Size: %d\nDescription: synthetic package %s\n generated by pkgbench\n" % \
+              (name, version, arch, (size + 1023) / 1024, name)
+    data = [('./usr/share/%s/payload' % (name), os.urandom(size))]
+    with open(path,'wb') as f:
+        f.write('!<arch>\n')
+        f.write(arMember('debian-binary','2.0\n'))
+        f.write(arMember('control.tar.gz',tarGz([('./control',control)])))
+        f.write(arMember('data.tar.gz',tarGz(data)))
+
+def summarize(samples):
+    # latency distribution in seconds
+    if len(samples) == 0:
+        return { 'count' : 0 }
+    samples = sorted(samples)
+    pick = lambda q: samples[min(int(q * len(samples)), len(samples) - 1)]
+    return OrderedDict([('count', len(samples)),
+                        ('mean', sum(samples) / len(samples)),
+                        ('p50', pick(0.5)),
+                        ('p90', pick(0.9)),
+                        ('p99', pick(0.99)),
+                        ('max', samples[-1])])
+
+class Bench:
+    def __init__(self,args):
+        self.args = args
+        self.workdir = None
+        self.conffile = None
+        self.server = None
+        self.packages = []
+        self.results = OrderedDict()
+
+    def timed(self,name,fn,*args):
+        start = time.time()
+        value = fn(*args)
+        self.results[name] = { 'seconds' : time.time() - start }
+        log.info("%s took %.3fs", name, self.results[name]['seconds'])
+        return value
+
+    def getRevision(self):
+        try:
+            return subprocess.check_output(['git','rev-parse','HEAD'],
+                                           cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           stderr=open(os.devnull,'w')).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def writeConf(self):
+        # same format as pkgrepo.conf
+        args = self.args
+        lines = ["[default]",
+                 "repodir = %s/repo" % (self.workdir),
+                 "architectures = %s" % (' '.join(args.arches)),
+                 "distname = bench",
+                 "branches = %s" % (' '.join(args.branches)),
+                 "compressions = %s" % (' '.join(args.compressions)),
+                 "publishdelay = %s" % (args.publishdelay)]
+        if args.workers != None:
+            lines.append("workers = %d" % (args.workers))
+        lines.append("")
+        lines.append("[releaseinfo]")
+        for key in ['Origin','Label','Suite','Codename','Description']:
+            lines.append("%s = pkgbench" % (key))
+        self.conffile = self.workdir + "/pkgrepo.conf"
+        with open(self.conffile,'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def getRepo(self):
+        repo = PackageRepo()
+        if not repo.setConfigFile(self.conffile):
+            raise ValueError("invalid conf file %s" % (self.conffile))
+        return repo
+
+    def generate(self,count,outdir,prefix):
+        # spread over the arches and versions , returns the filenames
+        args = self.args
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        filenames = []
+        for n in range(count):
+            name = "%s%05d" % (prefix, n / args.versions)
+            version = "1.%d" % (n % args.versions)
+            arch = args.arches[n % len(args.arches)]
+            filename = "%s_%s_%s.deb" % (name, version, arch)
+            makeDeb(outdir + "/" + filename, name, version, arch, args.size)
+            filenames.append(filename)
+        return filenames
+
+    def generateAll(self):
+        args = self.args
+        for n, branch in enumerate(args.branches):
+            count = args.packages / len(args.branches) + (1 if n < args.packages % len(args.branches) else 0)
+            filenames = self.generate(count, self.workdir + "/gen/" + branch, "bench")
+            self.packages.extend([(branch, filename) for filename in filenames])
+
+    def importAll(self,repo):
+        for branch in self.args.branches:
+            repo.processUploads(self.workdir + "/gen/" + branch, branch)
+
+    def benchIndex(self):
+        # cold : the package db is rebuilt , so every .deb is opened and hashed
+        repo = self.getRepo()
+        self.timed('rebuild_db', repo.rebuildDB)
+        self.timed('index_full', repo.doneUploads)
+        repo.close()
+
+    def benchRemove(self):
+        repo = self.getRepo()
+        samples = []
+        for branch, filename in self.packages[:self.args.removals]:
+            start = time.time()
+            repo.removePackage(filename,justbranch=branch)
+            samples.append(time.time() - start)
+        self.packages = self.packages[self.args.removals:]
+        repo.close()
+        self.results['remove'] = summarize(samples)
+
+    def startServer(self):
+        args = self.args
+        script = os.path.dirname(os.path.abspath(__file__)) + "/pkgrepo.py"
+        self.serverlog = open(self.workdir + "/server.log",'w')
+        self.server = subprocess.Popen([sys.executable, script, '-c', self.conffile, '--server',
+                                        '-p', str(args.port), '-t', str(args.threads)],
+                                       stdout=self.serverlog, stderr=subprocess.STDOUT)
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if self.server.poll() != None:
+                raise RuntimeError("server exited , see %s/server.log" % (self.workdir))
+            try:
+                socket.create_connection(('localhost',args.port),1).close()
+                return
+            except socket.error:
+                time.sleep(0.1)
+        raise RuntimeError("server did not start on port %d" % (args.port))
+
+    def stopServer(self):
+        if self.server == None:
+            return
+        self.server.send_signal(signal.SIGINT)
+        for n in range(50):
+            if self.server.poll() != None:
+                break
+            time.sleep(0.1)
+        else:
+            self.server.kill()
+            self.server.wait()
+        self.server = None
+        self.serverlog.close()
+
+    def request(self,conn,method,url,body=None,headers={}):
+        conn.request(method,url,body,headers)
+        response = conn.getresponse()
+        data = response.read()
+        if response.status >= 400:
+            raise RuntimeError("%s %s : %d %s" % (method, url, response.status, data[:200]))
+        return data
+
+    def benchUpload(self):
+        args = self.args
+        filenames = self.generate(args.uploads, self.workdir + "/single", "single")
+        conn = httplib.HTTPConnection('localhost',args.port)
+        samples = []
+        for filename in filenames:
+            with open(self.workdir + "/single/" + filename,'rb') as f:
+                body = f.read()
+            start = time.time()
+            self.request(conn,'POST','/?branch=%s&filename=%s&wait=1' % (args.branches[0], filename),body)
+            samples.append(time.time() - start)
+        conn.close()
+        self.results['upload'] = summarize(samples)
+
+    def benchBulk(self):
+        args = self.args
+        bulkdir = self.workdir + "/bulk"
+        filenames = self.generate(args.bulk, bulkdir, "bulk")
+        out = StringIO()
+        tar = tarfile.open(fileobj=out, mode='w')
+        for filename in filenames:
+            tar.add(bulkdir + "/" + filename, filename)
+        tar.close()
+        conn = httplib.HTTPConnection('localhost',args.port)
+        start = time.time()
+        self.request(conn,'POST','/bulk?branch=%s' % (args.branches[0]),out.getvalue(),
+                     { 'Content-Type' : 'application/x-tar' })
+        elapsed = time.time() - start
+        conn.close()
+        self.results['bulk'] = { 'seconds' : elapsed, 'packages' : len(filenames), 'bytes' : len(out.getvalue()) }
+
+    def benchDownload(self):
+        # clients fetch .debs round robin over keep-alive connections
+        args = self.args
+        urls = ["/dists/bench/%s/binary-%s/%s" % (branch, filename[:-4].split('_')[-1], filename)
+                for branch, filename in self.packages]
+        if len(urls) == 0:
+            return
+        lock = threading.Lock()
+        samples = []
+        sizes = []
+        errors = []
+        def client(offset):
+            conn = httplib.HTTPConnection('localhost',args.port)
+            mysamples = []
+            mysize = 0
+            try:
+                for n in range(offset, args.downloads, args.clients):
+                    start = time.time()
+                    mysize += len(self.request(conn,'GET',urls[n % len(urls)]))
+                    mysamples.append(time.time() - start)
+            except (RuntimeError, httplib.HTTPException, socket.error) as e:
+                errors.append(str(e))
+            finally:
+                conn.close()
+            with lock:
+                samples.extend(mysamples)
+                sizes.append(mysize)
+
+        threads = [threading.Thread(target=client,args=(n,)) for n in range(args.clients)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        result = summarize(samples)
+        result['seconds'] = elapsed
+        result['clients'] = args.clients
+        result['bytes'] = sum(sizes)
+        result['requests_per_second'] = len(samples) / elapsed
+        result['mb_per_second'] = sum(sizes) / elapsed / (1024 * 1024)
+        result['errors'] = len(errors)
+        self.results['download'] = result
+
+    def run(self):
+        args = self.args
+        self.workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='pkgbench')
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+        try:
+            self.writeConf()
+            self.timed('generate', self.generateAll)
+            repo = self.getRepo()
+            self.timed('setup', repo.setup)
+            self.timed('import', self.importAll, repo)
+            repo.close()
+            self.benchIndex()
+            self.benchRemove()
+            self.startServer()
+            try:
+                self.benchUpload()
+                self.benchBulk()
+                self.benchDownload()
+            finally:
+                self.stopServer()
+        finally:
+            if not args.keep:
+                shutil.rmtree(self.workdir, True)
+        params = OrderedDict([(key, getattr(args,key)) for key in
+                              ['packages','versions','size','branches','arches','compressions','workers',
+                               'publishdelay','removals','uploads','bulk','clients','downloads','threads']])
+        return OrderedDict([('revision', self.getRevision()),
+                            ('python', sys.version.split()[0]),
+                            ('time', time.strftime("%Y-%m-%dT%H:%M:%SZ",time.gmtime())),
+                            ('params', params),
+                            ('results', self.results)])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark a synthetic pkgrepo',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n','--packages', type=int, default=500, help = "packages in the initial repo")
+    parser.add_argument('--versions', type=int, default=2, help = "versions of each package name")
+    parser.add_argument('-s','--size', type=int, default=16*1024, help = "payload bytes per package")
+    parser.add_argument('--branches', nargs='+', default=['stable','test'])
+    parser.add_argument('--arches', nargs='+', default=['amd64','i386','all'])
+    parser.add_argument('--compressions', nargs='+', default=['gz','bz2'])
+    parser.add_argument('--workers', type=int, default=None, help = "repo worker processes")
+    parser.add_argument('--publishdelay', type=float, default=0, help = "server publish delay")
+    parser.add_argument('--removals', type=int, default=10, help = "packages removed one by one")
+    parser.add_argument('--uploads', type=int, default=20, help = "single uploads over http")
+    parser.add_argument('--bulk', type=int, default=100, help = "packages in the bulk upload")
+    parser.add_argument('--clients', type=int, default=8, help = "concurrent download clients")
+    parser.add_argument('--downloads', type=int, default=1000, help = "total downloads")
+    parser.add_argument('-t','--threads', type=int, default=16, help = "server worker threads")
+    parser.add_argument('-p','--port', type=int, default=8799, help = "server port")
+    parser.add_argument('-w','--workdir', default=None, help = "work dir , a temp dir by default")
+    parser.add_argument('-k','--keep', action="store_true", help = "keep the work dir")
+    parser.add_argument('-o','--output', default=None, help = "write the json results here instead of stdout")
+
+    args = parser.parse_args()
+    if len(args.branches) == 0 or len(args.arches) == 0 or args.versions < 1:
+        parser.print_usage()
+        sys.exit(1)
+
+    report = json.dumps(Bench(args).run(), indent=2)
+    if args.output:
+        with open(args.output,'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
@@ -1,15 +1,23 @@
 #!/usr/bin/env python
 import shlex
 import os
-import shutil
-import tempfile
 import re
+import time
+import hashlib
+import tarfile
+import pwd
+import grp
+from StringIO import StringIO
 import subprocess
 import glob
 import logging
 import argparse
 import types
 import sys
+import multiprocessing
+import traceback
+import tempfile
+import shutil
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger('pkg')
@@ -23,6 +31,90 @@ class FileItem:
         self.owner= None
         self.conf = False
 
+def arHeader(name,size,mtime):
+    # common ar format header , the member data is padded to an even size
+    return "%-16s%-12d%-6d%-6d%-8s%-10d`\n" % (name, mtime, 0, 0, '100644', size)
+
+def makeTar(files,mtime):
+    # an uncompressed tar of (name, data, mode) owned by root . its size only
+    # depends on the lengths of the files
+    out = StringIO()
+    tar = tarfile.open(fileobj=out, mode='w', format=tarfile.GNU_FORMAT)
+    for name, data, mode in files:
+        info = tarfile.TarInfo('./' + name)
+        info.size = len(data)
+        info.mtime = mtime
+        info.mode = mode
+        info.uname = info.gname = 'root'
+        tar.addfile(info, StringIO(data))
+    tar.close()
+    return out.getvalue()
+
+class HashReader:
+    # hands a file to the tar writer , md5ing and counting what it read
+    def __init__(self,f):
+        self.f = f
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def read(self,size=-1):
+        data = self.f.read(size)
+        self.md5.update(data)
+        self.size += len(data)
+        return data
+
+class DebWriter:
+    # writes a .deb in one go : debian-binary , control.tar , data.tar.gz .
+    # the control member needs the md5sums of the data , so its space is
+    # reserved first and filled in once the data has been streamed
+    def __init__(self,f,mtime):
+        self.f = f
+        self.mtime = mtime
+        self.f.write('!<arch>\n')
+        self.writeMember('debian-binary','2.0\n')
+
+    def writeMember(self,name,data):
+        self.f.write(arHeader(name,len(data),self.mtime))
+        self.f.write(data)
+        if len(data) % 2:
+            self.f.write('\n')
+
+    def reserveControl(self,files):
+        data = makeTar(files,self.mtime)
+        self.control = (self.f.tell(), len(data))
+        self.writeMember('control.tar','\0' * len(data))
+
+    def writeControl(self,files):
+        # files may come out shorter than what was reserved , tar readers
+        # stop at the end blocks so the rest is padded with zeros
+        data = makeTar(files,self.mtime)
+        offset, size = self.control
+        if len(data) > size:
+            raise ValueError("control.tar outgrew its space : %d > %d" % (len(data), size))
+        data += '\0' * (size - len(data))
+        end = self.f.tell()
+        self.f.seek(offset)
+        self.writeMember('control.tar',data)
+        self.f.seek(end)
+
+    def openData(self):
+        # the member size is patched in by closeData
+        self.datastart = self.f.tell()
+        self.f.write(arHeader('data.tar.gz',0,self.mtime))
+        self.data = tarfile.open(fileobj=self.f, mode='w|gz', format=tarfile.GNU_FORMAT)
+        return self.data
+
+    def closeData(self):
+        self.data.close()
+        end = self.f.tell()
+        size = end - self.datastart - 60
+        if size % 2:
+            self.f.write('\n')
+            end += 1
+        self.f.seek(self.datastart)
+        self.f.write(arHeader('data.tar.gz',size,self.mtime))
+        self.f.seek(end)
+
 class PkgCreate:
     def __init__(self):
         self.metadata=dict()
@@ -48,7 +140,6 @@ class PkgCreate:
 
         self.metadata[self.META_DEPENDS]=[]
         self.verbose = False
-        self.pkgdir=None
         self.keepTemp = False
         pass;
         
@@ -62,7 +153,7 @@ class PkgCreate:
                 line=line[:st] + ' ' + ' '.join(out) + ' ' + line[end+1:]
                 
         lexer = shlex.shlex(line)
-        lexer.wordchars += './-\\'
+        lexer.wordchars += './-\\*?'
         return list(lexer)
 
     def debug(self,data):
@@ -90,15 +181,14 @@ class PkgCreate:
                         self.processTokens(tokens)
             except :
                 log.error("process error on line [%d] : [%s] ", n, curline)
-                return 
+                return False
             self.debug("metadata = %s" % (self.metadata))
             self.debug("files = %s" %(self.files))
             if self.verify():
-                self.makePkgDir()
-                self.makePkg()
-        finally:
-            if self.pkgdir != None and not self.keepTemp:
-                shutil.rmtree(self.pkgdir,True)
+                return self.makePkg()
+        except (IOError, OSError) as e:
+            log.error("unable to read %s : %s", filename, e)
+        return False
 
     def processTokens(self,tokens):
         try :
@@ -233,6 +323,12 @@ class PkgCreate:
                     if not os.path.exists(f):
                         log.error('unable to locate file [%s]',f)
                         return False
+            if item.perms != None:
+                try:
+                    int(item.perms,8)
+                except ValueError:
+                    log.error('invalid perms [%s] for [%s] : octal like 755',item.perms,item.dest)
+                    return False
 
         # check the install scripts
         for key in [self.META_POSTINSTALL, self.META_PREINSTALL, self.META_POSTREMOVE, self.META_PREREMOVE]:
@@ -242,71 +338,216 @@ class PkgCreate:
                     return False
         return True
 
-    def writeControlFiles(self,debianDir):
-        with open(debianDir + '/control','w') as f: 
-            f.write('Package: %s\n' % (self.metadata[self.META_PACKAGE]))
-            f.write('Version: %s\n' % (self.metadata[self.META_VERSION]))
-            f.write('Maintainer: %s\n' % (self.metadata[self.META_MAINTAINER]))
-            f.write('Description: %s\n' %(self.metadata[self.META_DESCRIPTION]))
-            output = self.getCmdOutput('dpkg --print-architecture')
-            f.write('Architecture: %s\n' % (output[0]))
-            
-            if len(self.metadata[self.META_DEPENDS]) > 0 :
-                f.write('Depends: ')
-                maxlen=len(self.metadata[self.META_DEPENDS])
-                for n in range(0,maxlen):
-                    depends = self.metadata[self.META_DEPENDS][n]
-                    f.write(depends)
-                    if n < (maxlen-1):
-                        f.write(', ')
-                f.write('\n')
-
-        with open(debianDir + '/conffiles','w') as f:
-            for f in self.files:
-                if f.conf:
-                    f.write('%s\n' % (f.dest))
+    def getControlFiles(self,installedSize,md5sums):
+        # (name, data, mode) for control.tar
+        output = self.getCmdOutput('dpkg --print-architecture')
+        control = 'Package: %s\n' % (self.metadata[self.META_PACKAGE])
+        control += 'Version: %s\n' % (self.metadata[self.META_VERSION])
+        control += 'Maintainer: %s\n' % (self.metadata[self.META_MAINTAINER])
+        control += 'Description: %s\n' %(self.metadata[self.META_DESCRIPTION])
+        control += 'Architecture: %s\n' % (output[0])
+        control += 'Installed-Size: %d\n' % (installedSize)
+        if len(self.metadata[self.META_DEPENDS]) > 0 :
+            control += 'Depends: %s\n' % (', '.join(self.metadata[self.META_DEPENDS]))
+
+        files = [('control', control, 0644)]
+        files.append(('md5sums', ''.join(['%s  %s\n' % (md5, path) for path, md5 in md5sums]), 0644))
+        conffiles = [item.dest for item in self.files if item.conf]
+        if len(conffiles) > 0:
+            files.append(('conffiles', ''.join(['%s\n' % (dest) for dest in conffiles]), 0644))
 
         for key in [self.META_POSTINSTALL, self.META_PREINSTALL, self.META_POSTREMOVE, self.META_PREREMOVE]:
             if key in self.metadata:
-                shutil.copy2(self.metadata[key] , debianDir + '/' + self.controlname[key])
+                with open(self.metadata[key]) as f:
+                    files.append((self.controlname[key], f.read(), 0755))
+        return files
+
+    def getOwner(self,item):
+        # (uname, uid, gname, gid) , ids from this host when it knows the names ,
+        # dpkg goes by the names where they exist on the target
+        user, sep, group = (item.owner or 'root:root').partition(':')
+        group = group or user
+        try:
+            uid = pwd.getpwnam(user).pw_uid
+        except KeyError:
+            uid = 0
+        try:
+            gid = grp.getgrnam(group).gr_gid
+        except KeyError:
+            gid = 0
+        return user, uid, group, gid
+
+    def getEntries(self):
+        # path in the pkg -> (src or None for a dir , stat or None , item)
+        entries = dict()
+        def add(dest, src, st, item):
+            dest = os.path.normpath('/' + dest.lstrip('/'))
+            # parent dirs are made by us unless listed
+            parent = os.path.dirname(dest)
+            while parent != '/' and parent not in entries:
+                entries[parent] = (None, None, None)
+                parent = os.path.dirname(parent)
+            if entries.get(dest, (None, None, None))[2] == None or src != None:
+                entries[dest] = (src, st, item)
+
+        for item in self.files:
+            if item.src == None:
+                add(item.dest, None, None, item)
+                continue
+            for src in item.src:
+                dest = item.dest
+                if item.dir or len(item.src) > 1:
+                    dest = os.path.join(item.dest, os.path.basename(src.rstrip('/')))
+                if os.path.isdir(src):
+                    # a whole tree
+                    for root, dirs, files in os.walk(src):
+                        base = os.path.join(dest, os.path.relpath(root, src))
+                        add(base, None, os.stat(root), item)
+                        for name in files:
+                            path = os.path.join(root, name)
+                            add(os.path.join(base, name), path, os.stat(path), item)
+                else:
+                    add(dest, src, os.stat(src), item)
+        return entries
+
+    def getTarInfo(self,path,src,st,item):
+        # perms apply to the files of an item and to a dir it names , the
+        # dirs of a source tree keep their mode
+        info = tarfile.TarInfo('.' + path)
+        if src == None:
+            info.type = tarfile.DIRTYPE
+            info.name = '.' + path.rstrip('/') + '/'
+        info.uname, info.uid, info.gname, info.gid = self.getOwner(item or FileItem())
+        if st == None:
+            info.mode = 0755
+            info.mtime = int(time.time())
+        else:
+            info.mode = st.st_mode & 07777
+            info.mtime = int(st.st_mtime)
+        if item != None and item.perms != None and (src != None or st == None):
+            info.mode = int(item.perms,8)
+        return info
+
+    def writeDeb(self,f):
+        # streams the files straight from their source into the .deb ,
+        # md5sums and Installed-Size come from the very bytes written
+        entries = self.getEntries()
+        paths = sorted(entries, key=lambda path: path.split('/'))
+
+        # the control files are reserved with md5s of the same width and an
+        # Installed-Size no real one is wider than
+        md5sums = [(path.lstrip('/'), '0' * 32) for path in paths if entries[path][0] != None]
+        deb = DebWriter(f,int(time.time()))
+        deb.reserveControl(self.getControlFiles(10 ** 20 - 1,md5sums))
+
+        # dpkg counts each file in KiB rounded up , dirs as 1
+        installedSize = 0
+        md5sums = []
+        data = deb.openData()
+        data.addfile(self.getTarInfo('/',None,None,None))
+        for path in paths:
+            src, st, item = entries[path]
+            info = self.getTarInfo(path,src,st,item)
+            if src == None:
+                data.addfile(info)
+                installedSize += 1
+                continue
+            self.debug("add: src: %s, dest: %s " %(src,path))
+            with open(src,'rb') as fsrc:
+                # the tar header needs the size up front , the size at the
+                # time it was opened . exactly that much is read
+                info.size = os.fstat(fsrc.fileno()).st_size
+                reader = HashReader(fsrc)
+                data.addfile(info, reader)
+            installedSize += (reader.size + 1023) / 1024
+            md5sums.append((path.lstrip('/'), reader.md5.hexdigest()))
+        deb.closeData()
+
+        deb.writeControl(self.getControlFiles(installedSize,md5sums))
 
     def makePkg(self):
         debfile="%s_%s.deb" % (self.metadata[self.META_PACKAGE],self.metadata[self.META_VERSION])
         log.info('creating %s' % (debfile))
-        subprocess.call(['dpkg-deb', '--build', self.pkgdir ,debfile])
-
-    def makePkgDir(self):
-        self.pkgdir=tempfile.mkdtemp(dir="./")
-        self.debug("pkgdir = %s" %( self.pkgdir))
-        for item in self.files:
-            dest = self.pkgdir + item.dest
-            if item.dir:
-                self.debug('making dir : %s', self.dest)
-                os.makedirs(dest)
-                for f in item.src:
-                    self.debug("copy: src: %s, dest: %s " %(f,dest))
-            else :
-                destdir = os.path.dirname(dest)
-                self.debug ('destfile: %s , destdir: %s' % ( dest , destdir))
-                os.makedirs(destdir)
-                self.debug("copy: src: %s, dest: %s " %(item.src[0],dest))
-                shutil.copy2(item.src[0],dest)
-
-        debianDir = self.pkgdir + "/DEBIAN"
-        os.mkdir(debianDir)
-        self.writeControlFiles(debianDir)
+        # unique , so builds running side by side never share one
+        fd, tmpfile = tempfile.mkstemp(dir='.', prefix='.%s.' % (debfile))
+        try:
+            with os.fdopen(fd,'wb') as f:
+                self.writeDeb(f)
+            os.chmod(tmpfile,0644)
+            os.rename(tmpfile,debfile)
+            return True
+        except (IOError, OSError, ValueError) as e:
+            log.error('unable to create %s : %s', debfile, e)
+            return False
+        finally:
+            if os.path.exists(tmpfile) and not self.keepTemp:
+                os.remove(tmpfile)
+
+def buildPkg(job):
+    # runs in a worker process of its own , with a fresh PkgCreate and temp
+    # dir , and hands back (n, pkgfile, ok, seconds, log output) . the log
+    # file takes the process's stdout and stderr too , so the output of
+    # shell commands in backticks is kept with the package
+    n, pkgfile, verbose, keepTemp = job
+    tmpdir = tempfile.mkdtemp(prefix='pkgcreate-')
+    os.environ['TMPDIR'] = tempfile.tempdir = tmpdir
+    out = open(tmpdir + '/log','w+',0)
+    saved = [os.dup(1), os.dup(2)]
+    os.dup2(out.fileno(),1)
+    os.dup2(out.fileno(),2)
+    handler = logging.StreamHandler(out)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    sys.stdout = out
+    start = time.time()
+    ok = False
+    try:
+        pkg = PkgCreate()
+        pkg.verbose  = verbose
+        pkg.keepTemp = keepTemp
+        ok = pkg.process(pkgfile)
+    except Exception:
+        log.error("failed : %s", traceback.format_exc())
+    finally:
+        sys.stdout = sys.__stdout__
+        os.dup2(saved[0],1)
+        os.dup2(saved[1],2)
+        out.seek(0)
+        output = out.read()
+        out.close()
+        shutil.rmtree(tmpdir,True)
+    return n, pkgfile, ok, time.time() - start, output
+
+def buildAll(pkgfiles,jobs,verbose,keepTemp):
+    # one process per pkgdef , each log is printed in one piece once its
+    # build is done . returns the results in pkgfile order
+    pool = multiprocessing.Pool(jobs, maxtasksperchild=1)
+    results = [None] * len(pkgfiles)
+    try:
+        builds = pool.imap_unordered(buildPkg, [(n, pkgfile, verbose, keepTemp) for n, pkgfile in enumerate(pkgfiles)])
+        for count in range(len(pkgfiles)):
+            # a timeout keeps ctrl-c working while waiting
+            n, pkgfile, ok, seconds, output = builds.next(sys.maxint)
+            sys.stderr.write('==> %s : %s in %.2fs\n%s' % (pkgfile, 'ok' if ok else 'FAILED', seconds, output))
+            results[n] = (pkgfile, ok, seconds)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Debian Pkg Maker',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-v','--verbose', action="store_true" , default=False, help = "be more verbose" )
     parser.add_argument('-k','--keeptemp', action="store_true", default=False, help = "keep temporary files")
+    parser.add_argument('-j','--jobs', type=int, default=1, help = "pkgdefs to build in parallel , each in its own process")
     parser.add_argument('pkgfiles', nargs=argparse.REMAINDER)
 
     args = parser.parse_args()
-
-    pkg=PkgCreate()
-    pkg.verbose  = args.verbose
-    pkg.keepTemp = args.keeptemp
+    started = time.time()
 
     if len(args.pkgfiles) == 0:
         args.pkgfiles = glob.glob('*.pkgdef')
@@ -315,5 +556,30 @@ if __name__ == '__main__':
         log.error("no .pkgdef files found..")
         sys.exit(0)
 
-    for pkgfile in args.pkgfiles:
-        pkg.process(pkgfile)
+    # a pkgdef named twice is built once
+    seen = set()
+    args.pkgfiles = [pkgfile for pkgfile in args.pkgfiles
+                     if not (os.path.realpath(pkgfile) in seen or seen.add(os.path.realpath(pkgfile)))]
+
+    results = []
+    try:
+        if args.jobs > 1:
+            results = buildAll(args.pkgfiles,args.jobs,args.verbose,args.keeptemp)
+        else:
+            for pkgfile in args.pkgfiles:
+                start = time.time()
+                pkg=PkgCreate()
+                pkg.verbose  = args.verbose
+                pkg.keepTemp = args.keeptemp
+                results.append((pkgfile, pkg.process(pkgfile), time.time() - start))
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+    if len(results) > 1:
+        sys.stderr.write('\n')
+        for pkgfile, ok, seconds in results:
+            sys.stderr.write('%-8s %8.2fs  %s\n' % ('ok' if ok else 'FAILED', seconds, pkgfile))
+        sys.stderr.write('%d of %d built in %.2fs\n' % (len([r for r in results if r[1]]), len(results), time.time() - started))
+
+    if [r for r in results if not r[1]]:
+        sys.exit(1)
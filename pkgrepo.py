@@ -14,15 +14,1282 @@ import cgi
 import re
 from urlparse import urlparse, parse_qs
 import tempfile
+import time
+import multiprocessing
+import signal
+import threading
+import Queue
+import posixpath
+import urllib
+import uuid
+import json
+import socket
+import stat
+import httplib
+import difflib
+import bisect
+import fnmatch
+from contextlib import contextmanager
+import tarfile
+import zlib
+import bz2
+import sqlite3
+import fcntl
+from collections import OrderedDict
+from cStringIO import StringIO
+from email.utils import parsedate_tz, mktime_tz
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        # pysendfile, for pythons without os.sendfile
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger('pkgrepo')
 
+CHUNKSIZE = 64 * 1024
+COMPRESSIONS = ['gz','bz2','xz']
+
+# what a broken .deb can throw at us while it is being read
+DEBERRORS = (ValueError, IOError, EOFError, tarfile.TarError, zlib.error)
+
+# deb(5) : allowed compressors of each member , and their magic bytes
+CONTROLTYPES = ['', '.gz', '.xz', '.zst']
+DATATYPES = ['', '.gz', '.bz2', '.lzma', '.xz', '.zst']
+MAGIC = { '.gz' : '\x1f\x8b', '.bz2' : 'BZh', '.xz' : '\xfd7zXZ\x00',
+          '.lzma' : '\x5d\x00\x00', '.zst' : '\x28\xb5\x2f\xfd' }
+
+def digestFile(path):
+    # one streaming pass over the file for all the digests we publish
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path,'rb') as f:
+        while True:
+            data = f.read(CHUNKSIZE)
+            if not data:
+                break
+            size += len(data)
+            md5.update(data)
+            sha1.update(data)
+            sha256.update(data)
+    return (size, md5.hexdigest(), sha1.hexdigest(), sha256.hexdigest())
+
+def writeAtomic(path,data):
+    # readers either see the old file or the new one, never a partial write
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd,'wb') as f:
+            f.write(data)
+        os.chmod(tmpfile,0644)
+        os.rename(tmpfile,path)
+    except:
+        os.remove(tmpfile)
+        raise
+
+def initWorker():
+    # ctrl-c is for the parent , a worker dying on it hangs the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def compressFile(task):
+    # pool worker : write src.<fmt> next to src , atomically
+    src, fmt = task
+    dest = src + '.' + fmt
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.' + os.path.basename(dest))
+    try:
+        with os.fdopen(fd,'wb') as f:
+            with open(src,'rb') as inp:
+                if fmt == 'xz' and lzma == None:
+                    p1 = subprocess.Popen(['xz','-9','-c'],stdin=inp,stdout=f)
+                    if p1.wait() != 0:
+                        raise IOError("xz failed with [%d] on %s" % (p1.returncode,src))
+                else:
+                    if fmt == 'gz':
+                        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                    elif fmt == 'bz2':
+                        compressor = bz2.BZ2Compressor(9)
+                    else:
+                        compressor = lzma.LZMACompressor(preset=9)
+                    while True:
+                        data = inp.read(CHUNKSIZE)
+                        if not data:
+                            break
+                        f.write(compressor.compress(data))
+                    f.write(compressor.flush())
+        os.chmod(tmpfile,0644)
+        os.rename(tmpfile,dest)
+    except:
+        os.remove(tmpfile)
+        raise
+    return dest
+
+def gzipData(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def edDiff(old,new):
+    # ed script turning the old lines into the new ones, as used by
+    # Packages.diff . hunks go last to first so line numbers stay valid
+    script = []
+    opcodes = difflib.SequenceMatcher(None,old,new).get_opcodes()
+    for tag, i1, i2, j1, j2 in reversed(opcodes):
+        if tag == 'equal':
+            continue
+        if tag == 'insert':
+            script.append("%da\n" % (i1))
+        else:
+            lines = "%d" % (i1 + 1) if i2 - i1 == 1 else "%d,%d" % (i1 + 1, i2)
+            script.append("%s%s\n" % (lines, 'd' if tag == 'delete' else 'c'))
+        if tag != 'delete':
+            script.extend(new[j1:j2])
+            script.append(".\n")
+    return ''.join(script)
+
+def checkPackage(path):
+    # pool worker : validate and hash one .deb.
+    # returns (path, control, digests, error)
+    try:
+        control = DebArchive(path).validate(os.path.basename(path))
+        return (path, control, digestFile(path), None)
+    except DEBERRORS as e:
+        return (path, None, None, str(e).replace(path,os.path.basename(path)))
+
+def readPackage(path):
+    # pool worker : like checkPackage , but for .debs that are already
+    # published , so only what the index needs is read
+    try:
+        return (path, DebArchive(path).control(), digestFile(path), None)
+    except DEBERRORS as e:
+        return (path, None, None, str(e).replace(path,os.path.basename(path)))
+
+def decompress(data,ext):
+    if ext == '':
+        return data
+    if ext == '.gz':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if ext == '.bz2':
+        return bz2.decompress(data)
+    if ext == '.xz' and lzma != None:
+        return lzma.decompress(data)
+    # no python module for it .. let the tool do it
+    tools = { '.xz' : ['xz','-dc'], '.lzma' : ['xz','-dc','--format=lzma'], '.zst' : ['zstd','-dcq'] }
+    if ext not in tools:
+        raise ValueError("unknown compression : %s" % (ext))
+    p1 = subprocess.Popen(tools[ext],stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+    out = p1.communicate(data)[0]
+    if p1.returncode != 0:
+        raise ValueError("unable to decompress %s data" % (ext))
+    return out
+
+def parseControl(text):
+    fields = OrderedDict()
+    key = None
+    for line in text.split('\n'):
+        if len(line.strip()) == 0:
+            if len(fields) > 0:
+                break
+            continue
+        if line[0] in ' \t':
+            if key != None:
+                fields[key] += '\n' + line
+            continue
+        key, sep, value = line.partition(':')
+        if not sep:
+            raise ValueError("invalid control line : %s" % (line))
+        key = key.strip()
+        fields[key] = value.strip()
+    return fields
+
+def orderChar(c):
+    # dpkg sort order : ~ before everything , letters before other chars
+    if c == '~':
+        return -1
+    if c.isdigit() or c == '':
+        return 0
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+def compareVersionPart(a,b):
+    # dpkg's verrevcmp : alternating non-digit and digit runs
+    i = j = 0
+    while i < len(a) or j < len(b):
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac = orderChar(a[i:i+1])
+            bc = orderChar(b[j:j+1])
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == '0':
+            i += 1
+        while j < len(b) and b[j] == '0':
+            j += 1
+        firstdiff = 0
+        while i < len(a) and a[i].isdigit() and j < len(b) and b[j].isdigit():
+            if firstdiff == 0:
+                firstdiff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if firstdiff != 0:
+            return firstdiff
+    return 0
+
+def splitVersion(version):
+    # [epoch:]upstream[-revision]
+    epoch, sep, rest = version.partition(':')
+    if not sep:
+        epoch, rest = '0', version
+    upstream, sep, revision = rest.rpartition('-')
+    if not sep:
+        upstream, revision = rest, ''
+    try:
+        epoch = int(epoch)
+    except ValueError:
+        epoch = 0
+    return (epoch, upstream, revision)
+
+def compareVersions(a,b):
+    # debian version ordering , usable as a cmp function
+    ea, ua, ra = splitVersion(a)
+    eb, ub, rb = splitVersion(b)
+    if ea != eb:
+        return cmp(ea,eb)
+    result = compareVersionPart(ua,ub)
+    if result == 0:
+        result = compareVersionPart(ra,rb)
+    return cmp(result,0)
+
+class DebArchive:
+    ARMAGIC = '!<arch>\n'
+
+    def __init__(self,path):
+        self.path = path
+
+    def members(self):
+        # yields (name, offset, size) for each member of the ar archive
+        with open(self.path,'rb') as f:
+            if f.read(len(self.ARMAGIC)) != self.ARMAGIC:
+                raise ValueError("not an ar archive : %s" % (self.path))
+            offset = len(self.ARMAGIC)
+            while True:
+                header = f.read(60)
+                if len(header) == 0:
+                    break
+                if len(header) < 60 or header[58:60] != '`\n':
+                    raise ValueError("corrupt ar header in %s" % (self.path))
+                name = header[0:16].strip()
+                if name.endswith('/'):
+                    name = name[:-1]
+                size = int(header[48:58].strip())
+                offset += 60
+                yield (name, offset, size)
+                # members are padded to an even offset
+                offset += size + (size % 2)
+                f.seek(offset)
+
+    def readMember(self,prefix):
+        for name, offset, size in self.members():
+            if name.startswith(prefix):
+                with open(self.path,'rb') as f:
+                    f.seek(offset)
+                    return name, f.read(size)
+        raise ValueError("no %s member in %s" % (prefix,self.path))
+
+    def control(self,name=None,data=None):
+        if data == None:
+            name, data = self.readMember('control.tar')
+        data = decompress(data, name[len('control.tar'):])
+        tar = tarfile.open(fileobj=StringIO(data))
+        for member in tar.getmembers():
+            if member.name in ['control','./control']:
+                return parseControl(tar.extractfile(member).read())
+        raise ValueError("no control file in %s" % (self.path))
+
+    def validate(self,filename=None):
+        # the checks lintian -C deb-format did for us : ar layout, member
+        # order and compressors. returns the parsed control fields
+        members = [m for m in self.members() if not m[0].startswith('_')]
+        names = [m[0] for m in members]
+        if len(members) != 3 or names[0] != 'debian-binary' or \
+           not names[1].startswith('control.tar') or not names[2].startswith('data.tar'):
+            raise ValueError("unexpected members %s" % (names))
+
+        control = None
+        with open(self.path,'rb') as f:
+            for name, offset, size in members:
+                f.seek(offset)
+                if name == 'debian-binary':
+                    if not f.read(size).startswith('2.'):
+                        raise ValueError("unsupported deb format version")
+                    continue
+
+                prefix, ext = name.split('.tar',1)
+                if ext not in (CONTROLTYPES if prefix == 'control' else DATATYPES):
+                    raise ValueError("unsupported compression for %s" % (name))
+                if prefix == 'control':
+                    data = f.read(size)
+                else:
+                    data = f.read(8)
+                if ext != '' and not data.startswith(MAGIC[ext]):
+                    raise ValueError("%s is not %s compressed" % (name,ext))
+                if prefix == 'control':
+                    control = self.control(name,data)
+
+        for field in ['Package','Version','Architecture']:
+            if field not in control:
+                raise ValueError("missing %s in control" % (field))
+
+        if filename != None:
+            # name_version_arch.deb , version without the epoch
+            parts = os.path.basename(filename)[:-len('.deb')].split('_')
+            version = control['Version'].split(':',1)[-1]
+            if parts[0] != control['Package'] or parts[-1] != control['Architecture'] or \
+               (len(parts) == 3 and parts[1] != version):
+                raise ValueError("%s does not match %s_%s_%s.deb" % (filename,control['Package'],version,control['Architecture']))
+        return control
+
+class PackageDB:
+    # every published .deb : control fields , hashes and pool file , keyed
+    # by the Filename: of its index entry (relative to the repodir).
+    # the branch dirs and Packages files are built from this
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS packages (
+            filename TEXT PRIMARY KEY,
+            branch TEXT NOT NULL,
+            arch TEXT NOT NULL,
+            name TEXT NOT NULL,
+            version TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            md5 TEXT NOT NULL,
+            sha1 TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            control TEXT NOT NULL,
+            poolpath TEXT NOT NULL,
+            added REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS packages_dir ON packages (branch, arch);
+        CREATE INDEX IF NOT EXISTS packages_name ON packages (name);
+    """
+    COLUMNS = "filename, branch, arch, size, md5, sha1, sha256, control, poolpath, added"
+
+    def __init__(self,dbfile):
+        self.dbfile = dbfile
+        # one connection shared by the server threads
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.conn = sqlite3.connect(dbfile, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    @contextmanager
+    def transaction(self):
+        # everything in the block is committed together or not at all ,
+        # nested blocks join the outer one
+        with self.lock:
+            self.depth += 1
+            try:
+                yield
+            except:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.conn.rollback()
+                raise
+            self.depth -= 1
+            if self.depth == 0:
+                self.conn.commit()
+
+    def isPopulated(self):
+        # user_version is set once the db was filled from the branch dirs
+        with self.lock:
+            return self.conn.execute("PRAGMA user_version").fetchone()[0] > 0
+
+    def setPopulated(self):
+        with self.transaction():
+            self.conn.execute("PRAGMA user_version = 1")
+
+    def makeEntry(self,row):
+        filename, branch, arch, size, md5, sha1, sha256, control, poolpath, added = row
+        return { 'control' : parseControl(control), 'size' : size,
+                 'md5' : md5, 'sha1' : sha1, 'sha256' : sha256,
+                 'branch' : branch, 'arch' : arch, 'poolpath' : poolpath, 'added' : added }
+
+    def get(self,filename):
+        with self.lock:
+            row = self.conn.execute("SELECT %s FROM packages WHERE filename = ?" % (self.COLUMNS), (filename,)).fetchone()
+        return self.makeEntry(row) if row != None else None
+
+    def exists(self,filename):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM packages WHERE filename = ?", (filename,)).fetchone() != None
+
+    def add(self,filename,branch,arch,digests,control,poolpath,added=None):
+        size, md5, sha1, sha256 = digests
+        if added == None:
+            added = time.time()
+        text = '\n'.join(["%s: %s" % (key, value) for key, value in control.items()])
+        with self.transaction():
+            self.conn.execute("INSERT OR REPLACE INTO packages VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+                              (filename, branch, arch, control.get('Package',''), control.get('Version',''),
+                               size, md5, sha1, sha256, text, poolpath, added))
+
+    def remove(self,filename):
+        with self.transaction():
+            self.conn.execute("DELETE FROM packages WHERE filename = ?", (filename,))
+
+    def copy(self,src,dest,branch,arch):
+        # dest is a hardlink of src in another branch
+        with self.transaction():
+            self.conn.execute("INSERT OR REPLACE INTO packages SELECT ?, ?, ?, name, version, size, md5, sha1, "
+                              "sha256, control, poolpath, added FROM packages WHERE filename = ?",
+                              (dest, branch, arch, src))
+
+    def clear(self):
+        with self.transaction():
+            self.conn.execute("DELETE FROM packages")
+
+    def select(self,branch=None,arch=None,name=None):
+        # [(filename, entry)] , by name then filename
+        where = []
+        params = []
+        for column, value in [('branch',branch),('arch',arch),('name',name)]:
+            if value != None:
+                where.append("%s = ?" % (column))
+                params.append(value)
+        query = "SELECT %s FROM packages" % (self.COLUMNS)
+        if len(where) > 0:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY name, filename"
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [(row[0], self.makeEntry(row)) for row in rows]
+
+class BodyReader:
+    # file like read() over the chunks of a request body
+    def __init__(self,chunks):
+        self.chunks = chunks
+        self.buf = ''
+
+    def read(self,size=-1):
+        while size < 0 or len(self.buf) < size:
+            try:
+                self.buf += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self.buf = self.buf, ''
+        else:
+            data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def readline(self,size=-1):
+        # for cgi.FieldStorage
+        while '\n' not in self.buf and (size < 0 or len(self.buf) < size):
+            try:
+                self.buf += next(self.chunks)
+            except StopIteration:
+                break
+        end = self.buf.find('\n') + 1 or len(self.buf)
+        if size >= 0:
+            end = min(end,size)
+        data, self.buf = self.buf[:end], self.buf[end:]
+        return data
+
+class RepoLock:
+    # reentrant like an RLock , which orders the threads of this process ,
+    # plus an flock on a file in the state dir , which orders the
+    # processes writing the same repo (the server , --remove , --sync ...)
+    def __init__(self,path=None):
+        self.path = path
+        self.rlock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+
+    def acquire(self):
+        self.rlock.acquire()
+        try:
+            if self.depth == 0 and self.path != None:
+                if self.fd == None:
+                    if not os.path.isdir(os.path.dirname(self.path)):
+                        os.makedirs(os.path.dirname(self.path))
+                    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+                    fcntl.fcntl(self.fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except:
+            self.rlock.release()
+            raise
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and self.fd != None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.rlock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self,*exc):
+        self.release()
+
+class UploadError(Exception):
+    def __init__(self,code,message):
+        Exception.__init__(self,message)
+        self.code = code
+        self.message = message
+
+class PoolMixIn:
+    # like SocketServer.ThreadingMixIn, but with a fixed set of worker
+    # threads. when all of them are busy the accept loop blocks on the
+    # queue and new connections wait in the listen backlog
+    poolsize = 16
+    daemon_threads = True
+
+    def startWorkers(self):
+        self.requests = Queue.Queue(self.poolsize)
+        for n in range(0,self.poolsize):
+            t = threading.Thread(target=self.processRequests,name="http-%d" % (n))
+            t.daemon = self.daemon_threads
+            t.start()
+
+    def processRequests(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+class RepoHTTPServer(PoolMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+
+class Publisher:
+    # accepted uploads wait in the staging dir and everything that
+    # arrives within the publish delay goes out in one index pass
+    MAXSTATUS = 10000
+    # seconds an upload with wait=1 waits for its publish
+    WAITTIMEOUT = 300
+
+    def __init__(self,repo,delay):
+        self.repo = repo
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.pending = []
+        # the batch being published , still pending for isPending
+        self.publishing = []
+        self.status = OrderedDict()
+        self.events = dict()
+
+    def start(self):
+        t = threading.Thread(target=self.run,name="publisher")
+        t.daemon = True
+        t.start()
+
+    def submit(self,staged,pkgpath,digests,control):
+        uploadid = uuid.uuid4().hex
+        with self.cond:
+            self.pending.append((uploadid, staged, pkgpath, digests, control))
+            self.setStatus(uploadid, { 'id' : uploadid, 'filename' : os.path.basename(pkgpath), 'status' : 'queued' })
+            self.events[uploadid] = threading.Event()
+            self.cond.notify()
+        return uploadid
+
+    def isPending(self,pkgpath):
+        with self.cond:
+            return pkgpath in [item[2] for item in self.pending + self.publishing]
+
+    def setStatus(self,uploadid,status):
+        self.status[uploadid] = status
+        while len(self.status) > self.MAXSTATUS:
+            self.status.popitem(False)
+
+    def getStatus(self,uploadid):
+        with self.cond:
+            return self.status.get(uploadid)
+
+    def wait(self,uploadid,timeout=WAITTIMEOUT):
+        event = self.events.get(uploadid)
+        if event != None and not event.wait(timeout):
+            raise UploadError(504,"timed out waiting for upload %s to be published" % (uploadid))
+        return self.getStatus(uploadid)
+
+    def run(self):
+        while True:
+            batch = []
+            try:
+                with self.cond:
+                    while len(self.pending) == 0:
+                        self.cond.wait()
+                # let the rest of the burst arrive
+                time.sleep(self.delay)
+                with self.cond:
+                    batch = self.publishing = self.pending
+                    self.pending = []
+                results = self.publishBatch(batch)
+            except Exception as e:
+                log.exception("publisher failed")
+                results = dict([(item[0], ('failed', str(e), False)) for item in batch])
+            self.finishBatch(batch,results)
+
+    def publishBatch(self,batch):
+        # store and index the batch . returns uploadid -> (state, error, duplicate)
+        repo = self.repo
+        results = dict()
+        added = []
+        log.info("publishing %d uploads", len(batch))
+        with repo.lock:
+            try:
+                # a failed publish rolls back the db rows with it
+                with repo.getDB().transaction():
+                    for uploadid, staged, pkgpath, digests, control in batch:
+                        try:
+                            replaced = self.setAside(pkgpath,uploadid)
+                        except OSError as e:
+                            log.error("unable to stage %s : %s", pkgpath, e)
+                            results[uploadid] = ('failed', str(e), False)
+                            continue
+                        try:
+                            with repo.metrics.timed('publish.store'):
+                                duplicate = repo.storePackage(staged,digests[3],pkgpath)
+                            repo.recordPackage(pkgpath,digests,control)
+                            added.append((pkgpath, digests[3], replaced))
+                            results[uploadid] = ('published', None, duplicate)
+                        except (OSError, sqlite3.Error) as e:
+                            log.error("unable to stage %s : %s", pkgpath, e)
+                            self.unstore(pkgpath,digests[3],replaced)
+                            results[uploadid] = ('failed', str(e), False)
+                    with repo.metrics.timed('publish.index'):
+                        repo.publish([pkgpath for pkgpath, sha256, replaced in added])
+            except Exception as e:
+                log.exception("publish failed")
+                # the staged files went into the pool and go with it , the
+                # clients have to upload again
+                for pkgpath, sha256, replaced in added:
+                    self.unstore(pkgpath,sha256,replaced)
+                for uploadid in results:
+                    results[uploadid] = ('failed', str(e), False)
+                self.republish([pkgpath for pkgpath, sha256, replaced in added])
+                return results
+
+        for pkgpath, sha256, replaced in added:
+            if replaced != None:
+                self.dropAside(replaced)
+        return results
+
+    def setAside(self,pkgpath,uploadid):
+        # a published pkg about to be replaced keeps a second link , and
+        # its db entry , until the batch is in . returns (aside, entry) or None
+        repo = self.repo
+        if not os.path.exists(pkgpath):
+            return None
+        aside = "%s/uploads/.replaced-%s" % (repo.statedir,uploadid)
+        os.link(pkgpath,aside)
+        return aside, repo.getDB().get(repo.getFilename(pkgpath))
+
+    def dropAside(self,replaced):
+        aside, entry = replaced
+        os.remove(aside)
+        if entry != None and os.path.exists(entry['poolpath']) and os.stat(entry['poolpath']).st_nlink == 1:
+            log.info("removing %s from the pool", entry['poolpath'])
+            os.remove(entry['poolpath'])
+
+    def unstore(self,pkgpath,sha256,replaced):
+        # undo storePackage : drop the new file and put back the one it replaced
+        repo = self.repo
+        try:
+            if os.path.exists(pkgpath):
+                os.remove(pkgpath)
+            poolpath = repo.getPoolPath(sha256)
+            if os.path.exists(poolpath) and os.stat(poolpath).st_nlink == 1:
+                os.remove(poolpath)
+            if replaced != None:
+                aside, entry = replaced
+                os.rename(aside,pkgpath)
+                if entry != None:
+                    digests = (entry['size'], entry['md5'], entry['sha1'], entry['sha256'])
+                    repo.recordPackage(pkgpath,digests,entry['control'],entry['added'])
+        except (OSError, sqlite3.Error) as e:
+            log.error("unable to restore %s : %s", pkgpath, e)
+
+    def republish(self,pkgpaths):
+        # a failed publish may have rewritten some of the indexes already ,
+        # regenerate those from the rolled back db
+        repo = self.repo
+        pairs = sorted(set([repo.getBranchArch(pkgpath) for pkgpath in pkgpaths]))
+        try:
+            touched = []
+            for branch, arch in pairs:
+                repo.genPackagesFile(branch,arch)
+                touched.extend(repo.getIndexFiles(branch,arch))
+            if len(touched) > 0:
+                repo.genReleasesFile(touched)
+        except Exception:
+            log.exception("unable to regenerate the indexes of %s", pairs)
+
+    def finishBatch(self,batch,results):
+        # record the outcome and wake up the uploaders waiting on it
+        with self.cond:
+            self.publishing = []
+            for uploadid, staged, pkgpath, digests, control in batch:
+                state, error, duplicate = results.get(uploadid,('failed','not published',False))
+                if state == 'failed' and os.path.exists(staged):
+                    os.remove(staged)
+                status = dict(self.status.get(uploadid,{ 'id' : uploadid }))
+                status['status'] = state
+                if duplicate:
+                    # the same bytes were already in the pool
+                    status['duplicate'] = True
+                if error != None:
+                    status['error'] = error
+                self.setStatus(uploadid,status)
+                event = self.events.pop(uploadid,None)
+                if event != None:
+                    event.set()
+
+class Mirror:
+    # replicates the branches and arches of another pkgrepo : only the
+    # .debs whose content is not here yet are downloaded , over a few
+    # keep-alive connections , then everything is published in one pass
+    INDEXTYPES = ['.gz', '.xz', '.bz2', '']
+
+    def __init__(self,repo,url,dist=None,connections=8):
+        self.repo = repo
+        self.url = urlparse(url.rstrip('/'))
+        self.dist = dist if dist != None else repo.distname
+        self.connections = connections
+        self.syncdir = repo.statedir + "/sync"
+
+    def connect(self):
+        if self.url.scheme == 'https':
+            return httplib.HTTPSConnection(self.url.netloc, timeout=60)
+        return httplib.HTTPConnection(self.url.netloc, timeout=60)
+
+    def getUrlPath(self,relpath):
+        return self.url.path + '/' + urllib.quote(relpath)
+
+    def fetch(self,relpath):
+        conn = self.connect()
+        try:
+            conn.request('GET', self.getUrlPath(relpath))
+            response = conn.getresponse()
+            data = response.read()
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise IOError("unable to fetch %s : %d %s" % (relpath, response.status, response.reason))
+        return data
+
+    def getRelease(self):
+        # (fields, relpath -> (size, sha256)) of the remote Release
+        fields = parseControl(self.fetch("dists/%s/Release" % (self.dist)))
+        entries = dict()
+        for line in fields.get('SHA256','').split('\n'):
+            parts = line.split()
+            if len(parts) == 3:
+                entries[parts[2]] = (int(parts[1]), parts[0])
+        return fields, entries
+
+    def getRemoteIndex(self,branch,arch,entries):
+        # deb name -> stanza fields , or None when the remote has no such index
+        pkgfile = self.repo.getPackagesFile(branch,arch)
+        for ext in self.INDEXTYPES:
+            if pkgfile + ext not in entries:
+                continue
+            size, sha256 = entries[pkgfile + ext]
+            data = self.fetch("dists/%s/%s%s" % (self.dist, pkgfile, ext))
+            if len(data) != size or hashlib.sha256(data).hexdigest() != sha256:
+                raise IOError("%s%s does not match the remote Release" % (pkgfile, ext))
+            index = dict()
+            for stanza in decompress(data,ext).split('\n\n'):
+                stanza = stanza.strip('\n')
+                if len(stanza) == 0:
+                    continue
+                fields = parseControl(stanza)
+                name = os.path.basename(fields.get('Filename',''))
+                if not self.repo.nameformat.match(name) or name.startswith('.') or 'SHA256' not in fields:
+                    log.error("skipping remote entry %s", fields.get('Filename',''))
+                    continue
+                index[name] = fields
+            return index
+        return None
+
+    def plan(self):
+        # (pkgpath -> remote fields , [pkgpaths gone upstream])
+        repo = self.repo
+        release, entries = self.getRelease()
+        remotebranches = release.get('Components','').split()
+        remotearches = release.get('Architectures','').split()
+        wanted = dict()
+        removed = []
+        for branch in repo.branches:
+            if branch not in remotebranches:
+                log.warn("remote has no %s branch", branch)
+                continue
+            for arch in repo.architectures:
+                if arch not in remotearches:
+                    continue
+                index = self.getRemoteIndex(branch,arch,entries)
+                if index == None:
+                    continue
+                pkgdir = repo.getPackageDir(branch,arch)
+                local = dict([(os.path.basename(filename), entry) for filename, entry in repo.getDB().select(branch,arch)])
+                for name, fields in index.items():
+                    entry = local.pop(name,None)
+                    if entry == None or entry['sha256'] != fields['SHA256']:
+                        wanted[pkgdir + "/" + name] = fields
+                removed.extend([pkgdir + "/" + name for name in local])
+        return wanted, removed
+
+    def downloadFile(self,conn,fields):
+        # resumes a previous partial download , returns (path, digests)
+        size = int(fields['Size'])
+        sha256 = fields['SHA256']
+        partfile = "%s/%s.part" % (self.syncdir, sha256)
+        hashes = [hashlib.md5(), hashlib.sha1(), hashlib.sha256()]
+        offset = 0
+        if os.path.exists(partfile):
+            if os.path.getsize(partfile) > size:
+                os.remove(partfile)
+            else:
+                with open(partfile,'rb') as f:
+                    for data in iter(lambda: f.read(CHUNKSIZE), ''):
+                        for h in hashes:
+                            h.update(data)
+                        offset += len(data)
+
+        if offset < size:
+            headers = { 'Range' : 'bytes=%d-' % (offset) } if offset > 0 else {}
+            conn.request('GET', self.getUrlPath(fields['Filename']), None, headers)
+            response = conn.getresponse()
+            if response.status == 200:
+                # no resume , start over
+                hashes = [hashlib.md5(), hashlib.sha1(), hashlib.sha256()]
+                offset = 0
+                mode = 'wb'
+            elif response.status == 206 and offset > 0:
+                mode = 'ab'
+            else:
+                response.read()
+                raise IOError("unable to fetch %s : %d %s" % (fields['Filename'], response.status, response.reason))
+            with open(partfile,mode) as f:
+                while True:
+                    data = response.read(CHUNKSIZE)
+                    if not data:
+                        break
+                    offset += len(data)
+                    if offset > size:
+                        raise IOError("%s is larger than its index entry" % (fields['Filename']))
+                    for h in hashes:
+                        h.update(data)
+                    f.write(data)
+
+        digests = (offset, hashes[0].hexdigest(), hashes[1].hexdigest(), hashes[2].hexdigest())
+        if offset != size or digests[3] != sha256:
+            os.remove(partfile)
+            raise IOError("%s does not match its sha256" % (fields['Filename']))
+        os.chmod(partfile,0644)
+        return partfile, digests
+
+    def download(self,queue,results):
+        # thread : one connection , reused until an error
+        conn = None
+        while True:
+            try:
+                sha256, fields = queue.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                if conn == None:
+                    conn = self.connect()
+                results[sha256] = self.downloadFile(conn,fields)
+                log.info("fetched %s", fields['Filename'])
+            except (IOError, httplib.HTTPException) as e:
+                log.error("unable to fetch %s : %s", fields['Filename'], e)
+                results[sha256] = e
+                if conn != None:
+                    conn.close()
+                    conn = None
+        if conn != None:
+            conn.close()
+
+    def run(self):
+        repo = self.repo
+        wanted, removed = self.plan()
+
+        # one download per content , whatever the pool has is just linked
+        pending = dict()
+        for pkgpath, fields in wanted.items():
+            if not os.path.exists(repo.getPoolPath(fields['SHA256'])):
+                pending[fields['SHA256']] = fields
+        log.info("sync : %d packages to add , %d to download , %d to remove", len(wanted), len(pending), len(removed))
+
+        if not os.path.isdir(self.syncdir):
+            os.makedirs(self.syncdir)
+        for partfile in glob.glob(self.syncdir + "/*.part"):
+            if os.path.basename(partfile)[:-len('.part')] not in pending:
+                os.remove(partfile)
+
+        queue = Queue.Queue()
+        for item in sorted(pending.items()):
+            queue.put(item)
+        results = dict()
+        threads = [threading.Thread(target=self.download,args=(queue,results)) for n in range(min(self.connections,len(pending)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        added = []
+        failed = []
+        with repo.lock:
+            with repo.getDB().transaction():
+                for pkgpath, fields in sorted(wanted.items()):
+                    sha256 = fields['SHA256']
+                    result = results.get(sha256)
+                    try:
+                        if isinstance(result,Exception):
+                            raise result
+                        if result != None:
+                            path, digests = result
+                            repo.storePackage(path,sha256,pkgpath)
+                            # in the pool now , other branches just link it
+                            results[sha256] = None
+                        else:
+                            # the pool copy is left alone , only linked
+                            digests = (int(fields['Size']), fields.get('MD5sum',''), fields.get('SHA1',''), sha256)
+                            repo.storePackage(repo.getPoolPath(sha256),sha256,pkgpath,move=False)
+                        repo.recordPackage(pkgpath,digests,DebArchive(pkgpath).control())
+                        added.append(pkgpath)
+                    except DEBERRORS + (OSError,) as e:
+                        log.error("unable to add %s : %s", pkgpath, e)
+                        failed.append(repo.getFilename(pkgpath))
+                for pkgpath in removed:
+                    log.warn("removing package : %s", pkgpath)
+                    repo.unlinkPackage(pkgpath)
+            repo.publish(added,removed)
+
+        return { 'added' : len(added), 'downloaded' : len(pending) - len([r for r in results.values() if isinstance(r,Exception)]),
+                 'removed' : len(removed), 'failed' : failed }
+
+class IndexCache:
+    # the published index files (Release , Packages ...) in memory , with
+    # a gzip copy made on first demand , so update storms are answered
+    # without touching the disk. the repo clears it on every publish and
+    # an entry is restatted at most every RECHECK seconds , to notice
+    # changes made by other processes (--remove , --sync ...)
+    MAXFILE = 32 * 1024 * 1024
+    RECHECK = 1.0
+
+    def __init__(self,maxsize):
+        self.lock = threading.Lock()
+        self.maxsize = maxsize
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def discard(self,path):
+        with self.lock:
+            entry = self.entries.pop(path,None)
+            if entry != None:
+                self.size -= len(entry['data']) + len(entry['gzip'] or '')
+
+    def get(self,path):
+        # the entry for path , None when it is not a cacheable file
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(path,None)
+            if entry != None:
+                # most recently used last
+                self.entries[path] = entry
+        if entry != None and now - entry['checked'] < self.RECHECK:
+            return entry
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.discard(path)
+            return None
+        if entry != None and entry['stat'] == (st.st_size, st.st_mtime, st.st_ino):
+            entry['checked'] = now
+            return entry
+        self.discard(path)
+        if not stat.S_ISREG(st.st_mode) or st.st_size > self.MAXFILE:
+            return None
+
+        with open(path,'rb') as f:
+            data = f.read()
+        entry = { 'data' : data, 'gzip' : None, 'checked' : now,
+                  'stat' : (st.st_size, st.st_mtime, st.st_ino), 'mtime' : st.st_mtime,
+                  'etag' : '"%x-%x"' % (int(st.st_mtime), st.st_size) }
+        with self.lock:
+            self.entries[path] = entry
+            self.size += len(data)
+            self.evict()
+        return entry
+
+    def getGzip(self,entry):
+        if entry['gzip'] == None:
+            gzdata = gzipData(entry['data'])
+            with self.lock:
+                if entry['gzip'] == None:
+                    entry['gzip'] = gzdata
+                    self.size += len(gzdata)
+                    self.evict()
+        return entry['gzip']
+
+    def evict(self):
+        # lock held
+        while self.size > self.maxsize and len(self.entries) > 0:
+            path, entry = self.entries.popitem(False)
+            self.size -= len(entry['data']) + len(entry['gzip'] or '')
+
+class Catalogue:
+    # every published package in memory , indexed by name so the json
+    # api never has to touch the disk. records are keyed by
+    # (branch, arch, filename) like the Packages files they come from.
+    # sources has the stat of the Packages file each branch/arch was
+    # loaded for , the repo reloads a slice when that file changes
+    RECHECK = 1.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.packages = dict()
+        self.names = []
+        self.pairs = dict()
+        self.sources = dict()
+        self.checked = 0
+
+    def makeRecord(self,branch,arch,fields):
+        return { 'name' : fields.get('Package',''),
+                 'version' : fields.get('Version',''),
+                 'branch' : branch,
+                 'arch' : arch,
+                 'filename' : fields.get('Filename',''),
+                 'size' : int(fields.get('Size','0')),
+                 'sha256' : fields.get('SHA256','') }
+
+    def addRecord(self,record):
+        name = record['name']
+        key = (record['branch'], record['arch'], record['filename'])
+        if name not in self.packages:
+            self.packages[name] = dict()
+            bisect.insort(self.names,name)
+        self.packages[name][key] = record
+        self.pairs.setdefault(key[:2],dict())[key[2]] = name
+
+    def removeRecord(self,branch,arch,filename):
+        name = self.pairs.get((branch,arch),{}).pop(filename,None)
+        if name == None:
+            return
+        records = self.packages.get(name,{})
+        records.pop((branch,arch,filename),None)
+        if len(records) == 0:
+            self.packages.pop(name,None)
+            pos = bisect.bisect_left(self.names,name)
+            if pos < len(self.names) and self.names[pos] == name:
+                del self.names[pos]
+
+    def add(self,branch,arch,fields):
+        record = self.makeRecord(branch,arch,fields)
+        with self.lock:
+            self.removeRecord(branch,arch,record['filename'])
+            self.addRecord(record)
+
+    def remove(self,branch,arch,filename):
+        with self.lock:
+            self.removeRecord(branch,arch,filename)
+
+    def setIndex(self,branch,arch,packages):
+        # replace everything published for branch/arch , packages are
+        # the control fields with Filename , Size and SHA256
+        records = [self.makeRecord(branch,arch,fields) for fields in packages]
+        with self.lock:
+            for filename in self.pairs.get((branch,arch),{}).keys():
+                self.removeRecord(branch,arch,filename)
+            for record in records:
+                self.addRecord(record)
+
+    def select(self,name,branch=None,arch=None):
+        # newest version first
+        records = [record for record in self.packages.get(name,{}).values()
+                   if (branch == None or record['branch'] == branch) and (arch == None or record['arch'] == arch)]
+        records.sort(key=lambda record: (record['branch'], record['arch']))
+        records.sort(cmp=compareVersions, key=lambda record: record['version'], reverse=True)
+        return records
+
+    def versions(self,name,branch=None,arch=None):
+        with self.lock:
+            return self.select(name,branch,arch)
+
+    def latest(self,name,branch=None,arch=None):
+        with self.lock:
+            records = self.select(name,branch,arch)
+        return records[0] if len(records) > 0 else None
+
+    def query(self,prefix='',branch=None,arch=None,offset=0,limit=100):
+        # (total, records) for names starting with prefix , by name
+        total = 0
+        result = []
+        with self.lock:
+            pos = bisect.bisect_left(self.names,prefix)
+            while pos < len(self.names) and self.names[pos].startswith(prefix):
+                records = self.select(self.names[pos],branch,arch)
+                if total + len(records) > offset and len(result) < limit:
+                    start = max(offset - total,0)
+                    result.extend(records[start:start + limit - len(result)])
+                total += len(records)
+                pos += 1
+        return total, result
+
+class Metrics:
+    # counters , gauges and histograms , rendered in the prometheus text format
+    TIMEBUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    SIZEBUCKETS = tuple([4 ** n * 1024 for n in range(11)])
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = OrderedDict()
+        self.values = OrderedDict()
+
+    def define(self,name,kind,text,buckets=None):
+        self.kinds[name] = (kind, text, buckets)
+
+    def labelKey(self,name,labels):
+        if name not in self.kinds:
+            raise KeyError("undefined metric : %s" % (name))
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self,name,value=1,**labels):
+        key = self.labelKey(name,labels)
+        with self.lock:
+            self.values[key] = self.values.get(key,0) + value
+
+    def set(self,name,value,**labels):
+        key = self.labelKey(name,labels)
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self,name,value,**labels):
+        key = self.labelKey(name,labels)
+        buckets = self.kinds[name][2]
+        with self.lock:
+            hist = self.values.get(key)
+            if hist == None:
+                hist = self.values[key] = [[0] * len(buckets), 0.0, 0]
+            for n, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[0][n] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    @contextmanager
+    def timed(self,stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            log.debug("stage %s took %.3fs", stage, elapsed)
+            self.observe('pkgrepo_stage_seconds',elapsed,stage=stage)
+
+    def formatLabels(self,labels,extra=()):
+        labels = list(labels) + list(extra)
+        if len(labels) == 0:
+            return ''
+        return '{' + ','.join(['%s="%s"' % (k, str(v).replace('\\','\\\\').replace('"','\\"')) for k, v in labels]) + '}'
+
+    def render(self):
+        with self.lock:
+            values = [(key, value if not isinstance(value,list) else [list(value[0]), value[1], value[2]])
+                      for key, value in self.values.items()]
+        lines = []
+        for name, (kind, text, buckets) in self.kinds.items():
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for (metric, labels), value in values:
+                if metric != name:
+                    continue
+                if kind != 'histogram':
+                    lines.append("%s%s %s" % (name, self.formatLabels(labels), repr(value)))
+                    continue
+                counts, total, count = value
+                for bound, n in zip(buckets, counts):
+                    lines.append("%s_bucket%s %d" % (name, self.formatLabels(labels,[('le',repr(float(bound)))]), n))
+                lines.append("%s_bucket%s %d" % (name, self.formatLabels(labels,[('le','+Inf')]), count))
+                lines.append("%s_sum%s %s" % (name, self.formatLabels(labels), repr(total)))
+                lines.append("%s_count%s %d" % (name, self.formatLabels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+def formatStanza(entry,filename):
+    control = entry['control']
+    lines = []
+    for key, value in control.items():
+        if key != 'Description':
+            lines.append("%s: %s" % (key, value))
+    lines.append("Filename: %s" % (filename))
+    lines.append("Size: %d" % (entry['size']))
+    lines.append("MD5sum: %s" % (entry['md5']))
+    lines.append("SHA1: %s" % (entry['sha1']))
+    lines.append("SHA256: %s" % (entry['sha256']))
+    if 'Description' in control:
+        lines.append("Description: %s" % (control['Description']))
+    return '\n'.join(lines) + '\n'
+
 class PackageRepo:
     def __init__(self):
         self.conffile = None
         self.nameformat=re.compile("(.*)_([a-z0-9]+).deb")
         self.verbose = False
+        self.db = None
+        self.indexes = dict()
+        self.digests = dict()
+        self.pool = None
+        self.publisher = None
+        self.catalogue = None
+        self.indexcache = None
+        self.metrics = Metrics()
+        self.metrics.define('pkgrepo_stage_seconds','histogram','Time spent in each stage of uploads, indexing and removal.',Metrics.TIMEBUCKETS)
+        self.metrics.define('pkgrepo_request_seconds','histogram','HTTP request latency.',Metrics.TIMEBUCKETS)
+        self.metrics.define('pkgrepo_requests_total','counter','HTTP requests by method and status.')
+        self.metrics.define('pkgrepo_served_bytes_total','counter','Bytes of file content sent to clients.')
+        self.metrics.define('pkgrepo_upload_bytes','histogram','Size of uploaded packages.',Metrics.SIZEBUCKETS)
+        self.metrics.define('pkgrepo_index_bytes','histogram','Size of the Packages files written.',Metrics.SIZEBUCKETS)
+        self.metrics.define('pkgrepo_index_size_bytes','gauge','Current size of each Packages file.')
+        # serializes everything that rewrites the published indexes , across
+        # processes once the config says where the state dir is
+        self.lock = RepoLock()
 
     def getCmdOutput(self,cmd):
         if self.verbose:
@@ -54,12 +1321,56 @@ class PackageRepo:
             return False
 
         self.distdir = self.repodir + "/dists/" + self.distname
+        self.statedir = self.repodir + "/.pkgrepo"
+        self.lock.path = self.statedir + "/lock"
+        # every .deb once , by sha256 . branch dirs hold hardlinks
+        self.pooldir = self.repodir + "/pool"
         
         self.branches = self.config.get('default','branches').split(' ')
         if len(self.branches) == 0:
             log.error("branches need to be specified")
             return False
 
+        self.compressions = ['gz','bz2']
+        if self.config.has_option('default','compressions'):
+            self.compressions = self.config.get('default','compressions').split()
+            for fmt in self.compressions:
+                if fmt not in COMPRESSIONS:
+                    log.error("unknown compression [%s] : supported %s", fmt, COMPRESSIONS)
+                    return False
+
+        # in MB
+        self.maxuploadsize = 1024
+        if self.config.has_option('default','maxuploadsize'):
+            self.maxuploadsize = self.config.getint('default','maxuploadsize')
+        self.maxbulkfiles = 256
+        if self.config.has_option('default','maxbulkfiles'):
+            self.maxbulkfiles = self.config.getint('default','maxbulkfiles')
+
+        # seconds to collect uploads before publishing them together
+        self.publishdelay = 2.0
+        if self.config.has_option('default','publishdelay'):
+            self.publishdelay = self.config.getfloat('default','publishdelay')
+
+        # Packages versions to keep ed patches for , 0 to disable pdiffs
+        self.pdiffs = 20
+        if self.config.has_option('default','pdiffs'):
+            self.pdiffs = self.config.getint('default','pdiffs')
+
+        # seconds an index stays fetchable by-hash after it was replaced
+        self.byhashgrace = 3600
+        if self.config.has_option('default','byhashgrace'):
+            self.byhashgrace = self.config.getint('default','byhashgrace')
+
+        # MB of index files the server keeps in memory , 0 to disable
+        self.indexcachesize = 64
+        if self.config.has_option('default','indexcache'):
+            self.indexcachesize = self.config.getint('default','indexcache')
+
+        self.workers = multiprocessing.cpu_count()
+        if self.config.has_option('default','workers'):
+            self.workers = self.config.getint('default','workers')
+
         self.origin =  self.config.get('releaseinfo','origin')
         self.label =  self.config.get('releaseinfo','label')
         self.suite = self.config.get('releaseinfo','suite')
@@ -70,10 +1381,15 @@ class PackageRepo:
     def setup(self):
         os.makedirs(self.repodir)
         os.makedirs(self.distdir)
+        os.makedirs(self.statedir)
+        os.makedirs(self.pooldir)
 
         for branch in self.branches:
             for arch in self.architectures:
                 os.makedirs(self.distdir + "/" + branch + "/binary-" + arch)
+
+        # start with empty indexes so every branch/arch is in the Release
+        self.doneUploads()
     
     # this is relative
     def getPackagesFile(self,branch='test',arch='amd64'):
@@ -99,9 +1415,252 @@ class PackageRepo:
         path = self.getPackageLocation(pkgname,branch,arch)
         if path == None:
             return False
-        return os.path.exists(path)
+        return self.getDB().exists(self.getFilename(path))
+
+    def getPoolPath(self,sha256):
+        return "%s/%s/%s.deb" % (self.pooldir,sha256[:2],sha256)
+
+    def isTaken(self,pkgname,branch):
+        # in the branch , or an upload of it is waiting to be published
+        if self.pkgExists(pkgname,branch):
+            return True
+        return self.publisher != None and self.publisher.isPending(self.getPackageLocation(pkgname,branch))
+
+    def storePackage(self,path,sha256,pkgpath,move=True):
+        # put the .deb in the pool , unless the same bytes are already
+        # there , and hardlink it into its branch dir.
+        # returns True when it was a duplicate
+        if os.path.exists(pkgpath):
+            self.unlinkPackage(pkgpath)
+
+        poolpath = self.getPoolPath(sha256)
+        duplicate = os.path.exists(poolpath)
+        if duplicate:
+            log.info("%s already in the pool as %s", pkgpath, poolpath)
+            if move:
+                os.remove(path)
+        else:
+            if not os.path.isdir(os.path.dirname(poolpath)):
+                os.makedirs(os.path.dirname(poolpath))
+            if move:
+                os.rename(path,poolpath)
+            else:
+                fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(poolpath), prefix='.')
+                os.close(fd)
+                shutil.copyfile(path,tmpfile)
+                os.chmod(tmpfile,0644)
+                os.rename(tmpfile,poolpath)
+
+        os.link(poolpath,pkgpath)
+        return duplicate
+
+    def unlinkPackage(self,pkgpath):
+        # drop the branch link and its db entry , and the pool entry once
+        # nothing links to it
+        entry = self.getDB().get(self.getFilename(pkgpath))
+        poolpath = entry['poolpath'] if entry != None else None
+        os.remove(pkgpath)
+        self.getDB().remove(self.getFilename(pkgpath))
+        if poolpath != None and os.path.exists(poolpath) and os.stat(poolpath).st_nlink == 1:
+            log.info("removing %s from the pool", poolpath)
+            os.remove(poolpath)
+
+    def openDB(self):
+        if self.db == None:
+            if not os.path.isdir(self.statedir):
+                os.makedirs(self.statedir)
+            self.db = PackageDB(self.statedir + "/packages.db")
+        return self.db
+
+    def getDB(self):
+        if self.db == None:
+            self.openDB()
+            if not self.db.isPopulated():
+                # first run on this repo , learn what is already published
+                self.rebuildDB()
+                if os.path.exists(self.statedir + "/debcache"):
+                    # the pickled control cache the db replaces
+                    os.remove(self.statedir + "/debcache")
+        return self.db
+
+    def rebuildDB(self):
+        # recovery : forget the db and read every .deb in the branch dirs again
+        # under the lock from the listing on , so nothing changes the
+        # branch dirs while they are read
+        with self.lock:
+            pkgs = []
+            for branch in self.branches:
+                for arch in self.architectures:
+                    pkgdir = self.getPackageDir(branch,arch)
+                    if os.path.isdir(pkgdir):
+                        pkgs.extend([pkgdir + "/" + debfile for debfile in sorted(os.listdir(pkgdir)) if debfile.endswith('.deb')])
+
+            pool = self.getPool() if len(pkgs) > 1 else None
+            checked = pool.map(readPackage,pkgs) if pool != None else map(readPackage,pkgs)
+
+            db = self.openDB()
+            count = 0
+            with db.transaction():
+                db.clear()
+                for path, control, digests, error in checked:
+                    if error != None:
+                        log.error("skipping invalid package %s : %s", path, error)
+                        continue
+                    # the upload time is lost , the file's mtime is the best guess
+                    self.recordPackage(path,digests,control,os.stat(path).st_mtime)
+                    count += 1
+                db.setPopulated()
+            log.info("package db rebuilt with %d packages", count)
+
+    def getBranchArch(self,pkgpath):
+        # pkgpath is distdir/branch/binary-arch/name.deb
+        branch, archdir = os.path.relpath(os.path.dirname(pkgpath),self.distdir).split('/')
+        return branch, archdir[len('binary-'):]
+
+    def recordPackage(self,pkgpath,digests,control,added=None):
+        branch, arch = self.getBranchArch(pkgpath)
+        self.getDB().add(self.getFilename(pkgpath), branch, arch,
+                         digests, control, self.getPoolPath(digests[3]), added)
+
+    def getFilename(self,path):
+        # the Filename: field of a pkg, relative to the repodir
+        return os.path.relpath(path,self.repodir)
+
+    def getStanza(self,path):
+        # (package, stanza) for the .deb at path
+        entry = self.getDB().get(self.getFilename(path))
+        if entry == None:
+            raise ValueError("%s is not in the package db" % (self.getFilename(path)))
+        return (entry['control'].get('Package',''), formatStanza(entry,self.getFilename(path)))
+
+    def buildIndex(self,branch,arch):
+        # filename -> (package, stanza) for every .deb of branch/arch in the db
+        index = dict()
+        for filename, entry in self.getDB().select(branch,arch):
+            index[filename] = (entry['control'].get('Package',''), formatStanza(entry,filename))
+        return index
+
+    def getIndex(self,branch,arch):
+        # filename -> (package, stanza) as published in the Packages file
+        pkgfile = self.distdir + "/" + self.getPackagesFile(branch,arch)
+        try:
+            st = os.stat(pkgfile)
+        except OSError:
+            return None
+
+        cached = self.indexes.get((branch,arch))
+        if cached != None and cached[0] == st.st_size and cached[1] == st.st_mtime:
+            return dict(cached[2])
+
+        index = dict()
+        with open(pkgfile) as f:
+            for stanza in f.read().split('\n\n'):
+                stanza = stanza.strip('\n')
+                if len(stanza) == 0:
+                    continue
+                fields = parseControl(stanza)
+                index[fields['Filename']] = (fields.get('Package',''), stanza + '\n')
+        self.indexes[(branch,arch)] = (st.st_size, st.st_mtime, index)
+        return dict(index)
+
+    def writeIndex(self,branch,arch,index):
+        pkgfile = self.distdir + "/" + self.getPackagesFile(branch,arch)
+        stanzas = sorted([(pkg, filename, stanza) for filename, (pkg, stanza) in index.items()])
+        data = ''.join([stanza + '\n' for pkg, filename, stanza in stanzas])
+        olddata = None
+        if self.pdiffs > 0 and os.path.exists(pkgfile):
+            with open(pkgfile) as f:
+                olddata = f.read()
+
+        writeAtomic(pkgfile,data)
+        st = os.stat(pkgfile)
+        self.indexes[(branch,arch)] = (st.st_size, st.st_mtime, index)
+        if self.catalogue != None:
+            # the callers keep the catalogue in step , no reload needed
+            self.catalogue.sources[(branch,arch)] = (st.st_size, st.st_mtime, st.st_ino)
+        self.metrics.observe('pkgrepo_index_bytes',st.st_size)
+        self.metrics.set('pkgrepo_index_size_bytes',st.st_size,branch=branch,arch=arch)
+        log.info("wrote %d entries for %s:%s", len(stanzas), branch, arch)
+
+        if olddata != None and olddata != data:
+            self.updatePdiffs(branch,arch,olddata,data)
+
+    def readPdiffIndex(self,diffdir):
+        # patchname -> { History, Patches, Download : (sha256, size) } ,
+        # in the order the patches have to be applied
+        patches = OrderedDict()
+        section = None
+        try:
+            lines = [line.rstrip('\n') for line in open(diffdir + "/Index")]
+        except IOError:
+            return patches
+        for line in lines:
+            if not line.startswith(' '):
+                section = line.split(':')[0][len('SHA256-'):]
+                continue
+            digest, size, name = line.split()
+            if section == 'Download':
+                name = name[:-len('.gz')]
+            patches.setdefault(name,dict())[section] = (digest, int(size))
+        return patches
+
+    def updatePdiffs(self,branch,arch,olddata,data):
+        # keep the last N changes of Packages as ed patches , so apt
+        # only fetches what changed since its copy
+        diffdir = self.distdir + "/" + self.getPackagesFile(branch,arch) + ".diff"
+        if not os.path.isdir(diffdir):
+            os.makedirs(diffdir)
+        patches = self.readPdiffIndex(diffdir)
+
+        name = time.strftime("%Y-%m-%d-%H%M.%S",time.gmtime())
+        n = 0
+        while name in patches or os.path.exists(diffdir + "/" + name + ".gz"):
+            n += 1
+            name = time.strftime("%Y-%m-%d-%H%M.%S",time.gmtime()) + ".%d" % (n)
+
+        patch = edDiff(olddata.splitlines(True),data.splitlines(True))
+        download = gzipData(patch)
+        writeAtomic(diffdir + "/" + name + ".gz",download)
+        patches[name] = { 'History' : (hashlib.sha256(olddata).hexdigest(), len(olddata)),
+                          'Patches' : (hashlib.sha256(patch).hexdigest(), len(patch)),
+                          'Download' : (hashlib.sha256(download).hexdigest(), len(download)) }
+
+        while len(patches) > self.pdiffs:
+            oldest = patches.popitem(False)[0]
+            if os.path.exists(diffdir + "/" + oldest + ".gz"):
+                os.remove(diffdir + "/" + oldest + ".gz")
+
+        lines = ["SHA256-Current: %s %d" % (hashlib.sha256(data).hexdigest(), len(data))]
+        for section in ['History','Patches','Download']:
+            lines.append("SHA256-%s:" % (section))
+            for name, entry in patches.items():
+                if section not in entry:
+                    continue
+                digest, size = entry[section]
+                lines.append(" %s %7d %s%s" % (digest, size, name, '.gz' if section == 'Download' else ''))
+        writeAtomic(diffdir + "/Index",'\n'.join(lines) + '\n')
+
+    def getPool(self):
+        # created once and kept, so a server forks its workers up front
+        if self.pool == None and self.workers > 1:
+            self.pool = multiprocessing.Pool(self.workers,initWorker)
+        return self.pool
+
+    def compressIndexes(self,pairs):
+        # one task per branch/arch and format, spread over the pool
+        tasks = []
+        for branch, arch in pairs:
+            pkgfile = self.distdir + "/" + self.getPackagesFile(branch,arch)
+            tasks.extend([(pkgfile, fmt) for fmt in self.compressions])
+
+        pool = self.getPool() if len(tasks) > 1 else None
+        if pool != None:
+            pool.map(compressFile,tasks)
+        else:
+            map(compressFile,tasks)
 
     def genPackagesFile(self,justbranch=None,justarch=None):
+        pairs = []
         for branch in self.branches:
             if justbranch != None and justbranch != branch:
                 continue
@@ -109,124 +1668,840 @@ class PackageRepo:
                 if justarch !=None and justarch != arch:
                     continue
                 print 'generating pkg file for %s:%s' % (branch,arch)
-                os.chdir(self.repodir)
-                execstring = "dpkg-scanpackages dists/%s/%s/binary-%s /dev/null > %s/%s" % (self.distname,branch,arch,self.distdir,self.getPackagesFile(branch,arch))
-                ret = os.system (execstring)
-                if  ret != 0:
-                    print 'error : ', ret
-        
-                os.chdir(self.getPackageDir(branch,arch))
-                ret = os.system ('gzip -c -f -q -9 Packages > Packages.gz')
-                ret = os.system ('bzip2 -k -f -q -9 Packages')
-                
-    def genReleasesFile(self):
-        os.chdir(self.distdir)
-        os.system('pwd')
+                with self.metrics.timed('index.scan'):
+                    index = self.buildIndex(branch,arch)
+                with self.metrics.timed('index.write'):
+                    self.writeIndex(branch,arch,index)
+                if self.catalogue != None:
+                    self.catalogue.setIndex(branch,arch,[parseControl(stanza) for package, stanza in index.values()])
+                pairs.append((branch,arch))
+
+        with self.metrics.timed('index.compress'):
+            self.compressIndexes(pairs)
+
+    def updatePackagesFile(self,branch,arch,added=[],removed=[]):
+        # patch just the affected stanzas instead of rescanning the dir
+        with self.metrics.timed('index.scan'):
+            index = self.getIndex(branch,arch)
+            if index == None:
+                index = self.buildIndex(branch,arch)
+
+        for path in removed:
+            index.pop(self.getFilename(path),None)
+            if self.catalogue != None:
+                self.catalogue.remove(branch,arch,self.getFilename(path))
+
+        for path in added:
+            try:
+                index[self.getFilename(path)] = self.getStanza(path)
+            except DEBERRORS as e:
+                log.error("skipping invalid package %s : %s", path, e)
+                continue
+            if self.catalogue != None:
+                self.catalogue.add(branch,arch,parseControl(index[self.getFilename(path)][1]))
+
+        print 'updating pkg file for %s:%s' % (branch,arch)
+        with self.metrics.timed('index.write'):
+            self.writeIndex(branch,arch,index)
+
+    def loadCatalogue(self):
+        # from the package db , so no .deb has to be opened
+        self.catalogue = Catalogue()
         for branch in self.branches:
-            log.info( 'generating Release file for %s',branch)
-            f = open('Releases','w')
-            f.write("Origin: %s\n" %(self.origin))
-            f.write("Label: %s\n" %(self.label))
-            f.write("Suite: %s\n" %(self.suite))
-            f.write("Codename: %s\n" %(self.codename) )
-            f.write("Architectures: all\n")
-            f.write("Description: %s\n" % (self.description))
-        
-            
-            f.write("MD5Sum:\n")
             for arch in self.architectures:
-                pkgfile=self.getPackagesFile(branch,arch)                
-                f.write(" %s %20d %s\n" % (hashlib.md5(open(pkgfile).read()).hexdigest(),os.path.getsize(pkgfile),pkgfile))
-                f.write(" %s %20d %s\n" % (hashlib.md5(open(pkgfile).read()).hexdigest(),os.path.getsize(pkgfile + '.gz'),pkgfile+'.gz'))
-                f.write(" %s %20d %s\n" % (hashlib.md5(open(pkgfile).read()).hexdigest(),os.path.getsize(pkgfile + '.bz2'),pkgfile+'.bz2'))
+                self.loadCatalogueIndex(branch,arch,self.getPackagesStat(branch,arch))
+        self.catalogue.checked = time.time()
+        return self.catalogue
 
-            f.write("\n")
-        
-            f.write("SHA1:\n")
-            for arch in self.architectures:
-                pkgfile=self.getPackagesFile(branch,arch)
-                f.write(" %s %20d %s\n" % (hashlib.sha1(open(pkgfile).read()).hexdigest(),os.path.getsize(pkgfile),pkgfile))
-                f.write(" %s %20d %s\n" % (hashlib.sha1(open(pkgfile).read()).hexdigest(),os.path.getsize(pkgfile + '.gz'),pkgfile+'.gz'))
-                f.write(" %s %20d %s\n" % (hashlib.sha1(open(pkgfile).read()).hexdigest(),os.path.getsize(pkgfile + '.bz2'),pkgfile+'.bz2'))
+    def loadCatalogueIndex(self,branch,arch,source):
+        # source is the stat taken before reading , so a publish that
+        # races with the read is picked up by the next check
+        packages = []
+        for filename, entry in self.getDB().select(branch,arch):
+            fields = dict(entry['control'])
+            fields.update({ 'Filename' : filename, 'Size' : str(entry['size']), 'SHA256' : entry['sha256'] })
+            packages.append(fields)
+        self.catalogue.setIndex(branch,arch,packages)
+        self.catalogue.sources[(branch,arch)] = source
 
-            f.write("\n")
+    def getPackagesStat(self,branch,arch):
+        try:
+            st = os.stat(self.distdir + "/" + self.getPackagesFile(branch,arch))
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime, st.st_ino)
 
-            f.write("SHA256:\n")
+    def getCatalogue(self):
+        # every RECHECK seconds at most , reload the branch/arch slices
+        # whose Packages file changed since they were loaded . that is how
+        # --remove , --retain and --sync runs reach a running server
+        catalogue = self.catalogue
+        now = time.time()
+        if now - catalogue.checked < Catalogue.RECHECK:
+            return catalogue
+        catalogue.checked = now
+        for branch in self.branches:
             for arch in self.architectures:
-                pkgfile=self.getPackagesFile(branch,arch)
-                f.write(" %s %20d %s\n" % (hashlib.sha256(open(pkgfile).read()).hexdigest(),os.path.getsize(pkgfile),pkgfile))
-                f.write(" %s %20d %s\n" % (hashlib.sha256(open(pkgfile).read()).hexdigest(),os.path.getsize(pkgfile + '.gz'),pkgfile+'.gz'))
-                f.write(" %s %20d %s\n" % (hashlib.sha256(open(pkgfile).read()).hexdigest(),os.path.getsize(pkgfile + '.bz2'),pkgfile+'.bz2'))
+                source = self.getPackagesStat(branch,arch)
+                if catalogue.sources.get((branch,arch)) != source:
+                    log.info("reloading the catalogue for %s:%s", branch, arch)
+                    self.loadCatalogueIndex(branch,arch,source)
+        return catalogue
+
+    def getIndexFiles(self,branch,arch):
+        # relative to the distdir, like the Release entries
+        pkgfile = self.getPackagesFile(branch,arch)
+        files = [pkgfile] + [pkgfile + '.' + fmt for fmt in self.compressions]
+        if self.pdiffs > 0:
+            files.append(pkgfile + ".diff/Index")
+        return files
+
+    def readReleaseEntries(self):
+        # relpath -> (size, md5, sha1, sha256) from the current Release file
+        sections = { 'MD5Sum' : 1, 'SHA1' : 2, 'SHA256' : 3 }
+        entries = dict()
+        n = None
+        try:
+            lines = [line.rstrip('\n') for line in open(self.distdir + "/Release")]
+        except IOError:
+            return None
+
+        for line in lines:
+            if not line.startswith(' '):
+                n = sections.get(line.rstrip(':'))
+                continue
+            if n == None:
+                continue
+            digest, size, relpath = line.split()
+            entry = entries.setdefault(relpath,[int(size),None,None,None])
+            entry[n] = digest
+        return dict([(relpath, tuple(entry)) for relpath, entry in entries.items() if None not in entry])
 
-            f.write("\n")
+    def getDigests(self,path):
+        # (size, md5, sha1, sha256) of an index file, only rehashed
+        # when the file has been rewritten since we last read it
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime, st.st_ino)
+        cached = self.digests.get(path)
+        if cached != None and cached[0] == key:
+            return cached[1]
+        digests = digestFile(path)
+        self.digests[path] = (key, digests)
+        return digests
 
-        f.close()
+    def linkByHash(self,path,sha256):
+        # the immutable copy apt fetches when the Release says
+        # Acquire-By-Hash , a hardlink so it costs no space
+        hashdir = os.path.dirname(path) + "/by-hash/SHA256"
+        if not os.path.isdir(hashdir):
+            os.makedirs(hashdir)
+        if not os.path.exists(hashdir + "/" + sha256):
+            os.link(path,hashdir + "/" + sha256)
+        return hashdir
+
+    def cleanByHash(self,hashdir,keep):
+        # an index stops being current when its name is renamed over,
+        # which drops its link count and so sets its ctime
+        for digest in os.listdir(hashdir):
+            path = hashdir + "/" + digest
+            if digest not in keep and time.time() - os.stat(path).st_ctime > self.byhashgrace:
+                log.info("removing old index %s", path)
+                os.remove(path)
+
+    def genReleasesFile(self,touched=None):
+        entries = None
+        if touched != None:
+            entries = self.readReleaseEntries()
+
+        if entries == None:
+            entries = dict()
+            touched = []
+            for branch in self.branches:
+                for arch in self.architectures:
+                    touched.extend(self.getIndexFiles(branch,arch))
+
+        hashdirs = set()
+        with self.metrics.timed('release.hash'):
+            for relpath in touched:
+                path = self.distdir + "/" + relpath
+                if os.path.exists(path):
+                    entries[relpath] = self.getDigests(path)
+                    hashdirs.add(self.linkByHash(path,entries[relpath][3]))
+                else:
+                    entries.pop(relpath,None)
+                    self.digests.pop(path,None)
+
+        log.info('generating Release file for %s',self.distname)
+        relpaths = sorted(entries.keys())
+        lines = []
+        lines.append("Origin: %s" %(self.origin))
+        lines.append("Label: %s" %(self.label))
+        lines.append("Suite: %s" %(self.suite))
+        lines.append("Codename: %s" %(self.codename) )
+        lines.append("Date: %s" % (time.strftime("%a, %d %b %Y %H:%M:%S UTC",time.gmtime())))
+        lines.append("Architectures: %s" % (' '.join(self.architectures)))
+        lines.append("Components: %s" % (' '.join(self.branches)))
+        lines.append("Description: %s" % (self.description))
+        lines.append("Acquire-By-Hash: yes")
+
+        for n, name in [(1,'MD5Sum'),(2,'SHA1'),(3,'SHA256')]:
+            lines.append("%s:" % (name))
+            for relpath in relpaths:
+                lines.append(" %s %20d %s" % (entries[relpath][n],entries[relpath][0],relpath))
+        # everything it points to is in place , this makes it visible
+        with self.metrics.timed('release.write'):
+            writeAtomic(self.distdir + "/Release",'\n'.join(lines) + '\n')
+        if self.indexcache != None:
+            self.indexcache.clear()
+
+        keep = set([entry[3] for entry in entries.values()])
+        with self.metrics.timed('release.byhash'):
+            for hashdir in hashdirs:
+                self.cleanByHash(hashdir,keep)
 
     def doneUploads(self):
-        self.genPackagesFile();
-        self.genReleasesFile();
-
-    def processUploads(self,uploadsdir,branch):
-        count = 0
-        for srcpkg in glob.glob( "%s/*.deb" % (uploadsdir)):
-            # TODO : change to move later
-            match = self.nameformat.match(srcpkg)
-            if not match:
+        with self.lock:
+            self.genPackagesFile();
+            self.genReleasesFile();
+
+    def publish(self,added=[],removed=[]):
+        with self.lock:
+            self.publishChanges(added,removed)
+
+    def publishChanges(self,added,removed):
+        # group the changed pkgs by their branch/arch dir and
+        # patch only those Packages files and their Release entries
+        changes = dict()
+        for path in added:
+            changes.setdefault(os.path.dirname(path),([],[]))[0].append(path)
+        for path in removed:
+            changes.setdefault(os.path.dirname(path),([],[]))[1].append(path)
+
+        touched = []
+        pairs = []
+        for branch in self.branches:
+            for arch in self.architectures:
+                pkgdir = self.getPackageDir(branch,arch)
+                if pkgdir in changes:
+                    self.updatePackagesFile(branch,arch,*changes[pkgdir])
+                    touched.extend(self.getIndexFiles(branch,arch))
+                    pairs.append((branch,arch))
+
+        with self.metrics.timed('index.compress'):
+            self.compressIndexes(pairs)
+        if len(touched) > 0:
+            self.genReleasesFile(touched)
+
+    def processUploads(self,uploadsdir,branch,move=False,replace=True):
+        # validate all the .debs in parallel , then publish the good
+        # ones in a single index pass. returns a status per file
+        results = []
+        srcpkgs = []
+        for srcpkg in sorted(glob.glob( "%s/*.deb" % (uploadsdir))):
+            filename = os.path.basename(srcpkg)
+            match = self.nameformat.match(filename)
+            if not match or match.groups()[1] not in self.architectures:
                 log.error("pkg name not in expected format : %s" % (srcpkg))
+                results.append({ 'filename' : filename, 'status' : 'rejected', 'error' : 'unknown file name' })
                 continue
-            arch = match.groups()[1]
-            shutil.copy(srcpkg,self.getPackageDir(branch,arch))
-            count += 1
-        log.info ("processing [%d] packages" % (count))
-        self.genPackagesFile();
-        self.genReleasesFile();
+            if not replace and self.isTaken(filename,branch):
+                log.error("pkg already exists : %s",filename)
+                results.append({ 'filename' : filename, 'status' : 'rejected', 'error' : 'pkg already exists' })
+                continue
+            srcpkgs.append(srcpkg)
+
+        pool = self.getPool() if len(srcpkgs) > 1 else None
+        checked = pool.map(checkPackage,srcpkgs) if pool != None else map(checkPackage,srcpkgs)
+
+        added = []
+        with self.lock:
+            with self.getDB().transaction():
+                for srcpkg, control, digests, error in checked:
+                    filename = os.path.basename(srcpkg)
+                    if error != None:
+                        log.error("pkg not in debian format %s : %s" , filename, error)
+                        results.append({ 'filename' : filename, 'status' : 'rejected', 'error' : error })
+                        continue
+                    pkgpath = self.getPackageLocation(filename,branch)
+                    if not replace and self.isTaken(filename,branch):
+                        # a single upload got there while this one was checked
+                        log.error("pkg already exists : %s",filename)
+                        results.append({ 'filename' : filename, 'status' : 'rejected', 'error' : 'pkg already exists' })
+                        continue
+                    duplicate = self.storePackage(srcpkg,digests[3],pkgpath,move)
+                    self.recordPackage(pkgpath,digests,control)
+                    added.append(pkgpath)
+                    result = { 'filename' : filename, 'status' : 'published' }
+                    if duplicate:
+                        result['duplicate'] = True
+                    results.append(result)
+
+            log.info ("processing [%d] packages" % (len(added)))
+            self.publish(added)
+        return results
 
     def removePackage(self,pkgname,justbranch=None,justarch=None):
-        count = 0
+        pkgs = []
         for branch in self.branches:
             if justbranch != None and justbranch != branch:
                 continue
             for arch in self.architectures:
                 if justarch !=None and justarch != arch:
                     continue
-                
-                pkg = self.getPackageLocation(pkgname,branch,arch)
+                pkgs.append(self.getPackageLocation(pkgname,branch,arch))
 
-                if os.path.exists(pkg):
-                    log.warn("removing package : %s", pkg)
-                    os.remove(pkg)
-                    count += 1
-                    self.genPackagesFile(branch,arch)
-                    
-        if count > 0:
-            self.genReleasesFile()
-        else :
+        if len(self.removePackages(pkgs)) == 0:
             log.warn("unable to find [%s] in the repo" , pkgname)
+
+    def removePackages(self,pkgs):
+        # unlink them all , then one index pass for every dir touched
+        removed = []
+        with self.lock:
+            with self.metrics.timed('remove.unlink'), self.getDB().transaction():
+                for pkg in pkgs:
+                    if pkg != None and os.path.exists(pkg):
+                        log.warn("removing package : %s", pkg)
+                        self.unlinkPackage(pkg)
+                        removed.append(pkg)
+
+            if len(removed) > 0:
+                with self.metrics.timed('remove.publish'):
+                    self.publish(removed=removed)
+        return removed
+
+    def getExpired(self,branch,globs,keep=None,maxage=None):
+        # the .debs of branch whose name matches one of globs and that
+        # fall outside the policy , per name and arch : the newest keep
+        # versions always stay , and the rest only go once they are older
+        # than maxage days. returns [(path, version, age in days)]
+        groups = dict()
+        for filename, entry in self.getDB().select(branch):
+            name = entry['control'].get('Package','')
+            if not any([fnmatch.fnmatchcase(name,pattern) for pattern in globs]):
+                continue
+            age = (time.time() - entry['added']) / 86400
+            path = self.repodir + "/" + filename
+            groups.setdefault((name,entry['arch']),[]).append((entry['control'].get('Version',''), path, age))
+
+        expired = []
+        for key in sorted(groups.keys()):
+            versions = sorted(groups[key], cmp=compareVersions, key=lambda item: item[0], reverse=True)
+            for n, (version, path, age) in enumerate(versions):
+                if keep != None and n < keep:
+                    continue
+                if maxage != None and age <= maxage:
+                    continue
+                expired.append((path, version, age))
+        return expired
+
+    def retainPackages(self,branch,globs,keep=None,maxage=None,dryrun=False):
+        # apply a retention policy to branch . returns what was (or with
+        # dryrun , would be) removed
+        with self.lock:
+            expired = self.getExpired(branch,globs,keep,maxage)
+            if not dryrun:
+                self.removePackages([path for path, version, age in expired])
+        return expired
+
+    def promotePackage(self,pkgname,frombranch,tobranch):
+        # move a pkg between branches : one hardlink , no bytes copied
+        with self.lock:
+            src = self.getPackageLocation(pkgname,frombranch)
+            dest = self.getPackageLocation(pkgname,tobranch)
+            if src == None or not os.path.exists(src):
+                log.error("unable to find [%s] in %s", pkgname, frombranch)
+                return False
+            if os.path.exists(dest):
+                log.error("[%s] is already in %s", pkgname, tobranch)
+                return False
+            log.info("promoting %s from %s to %s", pkgname, frombranch, tobranch)
+            with self.getDB().transaction():
+                os.link(src,dest)
+                self.getDB().copy(self.getFilename(src),self.getFilename(dest),*self.getBranchArch(dest))
+                os.remove(src)
+                self.getDB().remove(self.getFilename(src))
+            self.publish([dest],[src])
+        return True
         
-    def server(self,port=8000):
+    def close(self):
+        if self.pool != None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.db != None:
+            self.db.close()
+            self.db = None
+
+    def server(self,port=8000,threads=16,backlog=64):
 
         class ServerHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             repo=None
-            
-            def sendOk(self):
-                self.send_response(200)
-                self.send_header("Content-type", "text/html")
+            # keep-alive, so apt can fetch all the indexes over one connection
+            protocol_version = "HTTP/1.1"
+            # status line , headers and small bodies go out in one write
+            wbufsize = -1
+            # seconds a connection may sit idle (or stall mid request) before
+            # it is closed , so idle keep-alive clients can't hold all workers
+            timeout = 30
+
+            def setup(self):
+                SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+                # the last short segment of a reply must not wait for the
+                # client's delayed ack on a keep-alive connection
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def parse_request(self):
+                self.started = time.time()
+                self.sentbytes = 0
+                return SimpleHTTPServer.SimpleHTTPRequestHandler.parse_request(self)
+
+            def send_response(self,code,message=None):
+                self.statuscode = code
+                SimpleHTTPServer.SimpleHTTPRequestHandler.send_response(self,code,message)
+
+            def handle_one_request(self):
+                self.started = None
+                self.statuscode = None
+                SimpleHTTPServer.SimpleHTTPRequestHandler.handle_one_request(self)
+                if self.started != None and self.statuscode != None:
+                    metrics = self.repo.metrics
+                    metrics.observe('pkgrepo_request_seconds',time.time() - self.started,method=self.command)
+                    metrics.inc('pkgrepo_requests_total',method=self.command,code=self.statuscode)
+                    if self.sentbytes > 0:
+                        metrics.inc('pkgrepo_served_bytes_total',self.sentbytes)
+
+            def sendJson(self,data,code=200):
+                body = json.dumps(data)
+                self.send_response(code)
+                self.send_header("Content-type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path.startswith('/uploads/'):
+                    status = self.repo.publisher.getStatus(path[len('/uploads/'):])
+                    if status == None:
+                        self.send_error(404,"unknown upload id")
+                        return
+                    self.sendJson(status)
+                    return
+                if path == '/metrics':
+                    body = self.repo.metrics.render()
+                    self.send_response(200)
+                    self.send_header("Content-type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                if path.startswith('/api/'):
+                    self.doApi(path,parse_qs(urlparse(self.path).query))
+                    return
+                SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+            def doApi(self,path,params):
+                # read only queries against the in memory catalogue
+                catalogue = self.repo.getCatalogue()
+                branch = params.get('branch',[None])[0]
+                arch = params.get('arch',[None])[0]
+                parts = path.rstrip('/').split('/')[2:]
+                if parts == ['packages']:
+                    try:
+                        offset = max(int(params.get('offset',['0'])[0]),0)
+                        limit = min(max(int(params.get('limit',['100'])[0]),0),1000)
+                    except ValueError:
+                        self.send_error(400,"invalid offset or limit")
+                        return
+                    prefix = params.get('prefix',[''])[0]
+                    total, records = catalogue.query(prefix,branch,arch,offset,limit)
+                    self.sendJson({ 'total' : total, 'offset' : offset, 'limit' : limit, 'packages' : records })
+                elif len(parts) == 2 and parts[0] == 'packages':
+                    records = catalogue.versions(parts[1],branch,arch)
+                    if len(records) == 0:
+                        self.send_error(404,"unknown package")
+                        return
+                    self.sendJson({ 'name' : parts[1], 'versions' : records })
+                elif len(parts) == 2 and parts[0] == 'latest':
+                    record = catalogue.latest(parts[1],branch,arch)
+                    if record == None:
+                        self.send_error(404,"unknown package")
+                        return
+                    self.sendJson(record)
+                else:
+                    self.send_error(404,"unknown api")
+
+            def translate_path(self,path):
+                # relative to the repodir and not the cwd of the process
+                path = posixpath.normpath(urllib.unquote(path.split('?',1)[0].split('#',1)[0]))
+                words = [word for word in path.split('/') if word and word not in (os.curdir, os.pardir)]
+                return os.path.join(self.repo.repodir,*words)
+
+            def notModified(self,mtime,etag):
+                etags = self.headers.get('If-None-Match')
+                if etags != None:
+                    return etags.strip() == '*' or etag in [e.strip() for e in etags.split(',')]
+                since = self.headers.get('If-Modified-Since')
+                if since != None:
+                    since = parsedate_tz(since)
+                    return since != None and int(mtime) <= mktime_tz(since)
+                return False
+
+            def getRange(self,size,etag,lastmodified):
+                # (start, end) of a single byte range , None for the whole
+                # file and -1 when the range can not be satisfied
+                byterange = self.headers.get('Range','')
+                if not byterange.startswith('bytes=') or ',' in byterange:
+                    return None
+                ifrange = self.headers.get('If-Range')
+                if ifrange != None and ifrange not in [etag,lastmodified]:
+                    return None
+                start, sep, end = byterange[len('bytes='):].strip().partition('-')
+                try:
+                    if start == '':
+                        start, end = max(0,size - int(end)), size - 1
+                    else:
+                        start, end = int(start), min(int(end),size - 1) if end != '' else size - 1
+                except ValueError:
+                    return None
+                if start >= size or start > end:
+                    return -1
+                return (start, end)
+
+            def acceptsGzip(self):
+                for coding in self.headers.get('Accept-Encoding','').split(','):
+                    name, sep, params = coding.partition(';')
+                    if name.strip().lower() in ['gzip','x-gzip']:
+                        return re.match(r'^\s*q\s*=\s*0(\.0*)?\s*$',params) == None
+                return False
+
+            def sendEntity(self,path,urlpath,size,mtime,etag,encoding=None,vary=False):
+                # status and headers for size bytes of content , returns
+                # the byte range to send or None when the reply is complete
+                lastmodified = self.date_time_string(mtime)
+                if self.notModified(mtime,etag):
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Last-Modified", lastmodified)
+                    if vary:
+                        self.send_header("Vary", "Accept-Encoding")
+                    self.end_headers()
+                    return None
+
+                byterange = self.getRange(size,etag,lastmodified)
+                if byterange == -1:
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */%d" % (size))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return None
+
+                if byterange == None:
+                    self.send_response(200)
+                    byterange = (0, size - 1)
+                else:
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes %d-%d/%d" % (byterange[0],byterange[1],size))
+                self.send_header("Content-type", self.guess_type(path))
+                if encoding != None:
+                    self.send_header("Content-Encoding", encoding)
+                if vary:
+                    self.send_header("Vary", "Accept-Encoding")
+                self.send_header("Content-Length", str(byterange[1] - byterange[0] + 1))
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", lastmodified)
+                if '/by-hash/' in urlpath:
+                    # the name is the content , safe to cache forever
+                    self.send_header("Cache-Control", "public, max-age=31536000, immutable")
                 self.end_headers()
+                return byterange
+
+            def sendCached(self,path,urlpath,entry):
+                # an index file from memory , gzipped when the client takes it
+                body = entry['data']
+                etag = entry['etag']
+                encoding = None
+                vary = os.path.splitext(path)[1] not in ['.gz','.bz2','.xz','.lzma','.zst']
+                if vary and 'Range' not in self.headers and self.acceptsGzip():
+                    body = self.repo.indexcache.getGzip(entry)
+                    etag = etag[:-1] + '-gzip"'
+                    encoding = 'gzip'
+                byterange = self.sendEntity(path,urlpath,len(body),entry['mtime'],etag,encoding,vary)
+                if byterange == None:
+                    return None
+                return StringIO(body[byterange[0]:byterange[1] + 1])
+
+            def send_head(self):
+                self.sendrange = None
+                urlpath = urllib.unquote(self.path.split('?',1)[0].split('#',1)[0])
+                path = self.translate_path(self.path)
+                if len([word for word in urlpath.split('/') if word.startswith('.')]) > 0:
+                    # repo state and half written index files
+                    self.send_error(404, "File not found")
+                    return None
+
+                if os.path.isdir(path):
+                    if not urlpath.endswith('/'):
+                        # the base class redirect has no body length , which
+                        # would stall a keep-alive client
+                        self.send_response(301)
+                        self.send_header("Location", self.path.split('?',1)[0] + "/")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return None
+                    return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+                repo = self.repo
+                if repo.indexcache != None and path.startswith(repo.distdir + "/") and not path.endswith('.deb'):
+                    entry = repo.indexcache.get(path)
+                    if entry != None:
+                        return self.sendCached(path,urlpath,entry)
+
+                try:
+                    f = open(path,'rb')
+                except IOError:
+                    self.send_error(404, "File not found")
+                    return None
+
+                st = os.fstat(f.fileno())
+                etag = '"%x-%x"' % (int(st.st_mtime), st.st_size)
+                byterange = self.sendEntity(path,urlpath,st.st_size,st.st_mtime,etag)
+                if byterange == None:
+                    f.close()
+                    return None
+                self.sendrange = byterange
+                return f
+
+            def copyfile(self,source,outputfile):
+                if self.sendrange == None:
+                    # directory listings and cached index files
+                    data = source.read()
+                    outputfile.write(data)
+                    self.sentbytes += len(data)
+                    return
+
+                offset = self.sendrange[0]
+                remaining = self.sendrange[1] - offset + 1
+                if sendfile != None:
+                    # straight from the page cache to the socket
+                    outputfile.flush()
+                    while remaining > 0:
+                        sent = sendfile(self.connection.fileno(), source.fileno(), offset, remaining)
+                        if sent == 0:
+                            break
+                        offset += sent
+                        remaining -= sent
+                        self.sentbytes += sent
+                    return
+
+                source.seek(offset)
+                while remaining > 0:
+                    data = source.read(min(remaining,CHUNKSIZE))
+                    if not data:
+                        break
+                    outputfile.write(data)
+                    remaining -= len(data)
+                    self.sentbytes += len(data)
 
             
+            def readBody(self,maxsize):
+                # yields the request body in chunks , either
+                # Content-Length delimited or chunked transfer encoded
+                if self.headers.get('Transfer-Encoding','').lower() == 'chunked':
+                    total = 0
+                    while True:
+                        try:
+                            size = int(self.rfile.readline(1024).split(';')[0].strip(),16)
+                        except ValueError:
+                            raise UploadError(400,"invalid chunked encoding")
+                        if size == 0:
+                            # skip any trailers
+                            while self.rfile.readline(1024) not in ['\r\n','\n','']:
+                                pass
+                            return
+                        total += size
+                        if total > maxsize:
+                            raise UploadError(413,"upload too large")
+                        while size > 0:
+                            data = self.rfile.read(min(size,CHUNKSIZE))
+                            if not data:
+                                raise UploadError(400,"truncated upload")
+                            size -= len(data)
+                            yield data
+                        self.rfile.readline(1024)
+                else:
+                    remaining = int(self.headers.get('Content-Length',0))
+                    while remaining > 0:
+                        data = self.rfile.read(min(remaining,CHUNKSIZE))
+                        if not data:
+                            raise UploadError(400,"truncated upload")
+                        remaining -= len(data)
+                        yield data
+
+            def receiveUpload(self,filename):
+                # stream the body to a temp file in the repo, hashing as we go.
+                # returns (temppath, (size, md5, sha1, sha256))
+                repo = self.repo
+                maxsize = repo.maxuploadsize * 1024 * 1024
+                if self.headers.get('Transfer-Encoding','').lower() != 'chunked':
+                    try:
+                        content_length = int(self.headers['Content-Length'])
+                    except (TypeError, ValueError):
+                        raise UploadError(411,"Content-Length required")
+                    if content_length > maxsize:
+                        raise UploadError(413,"upload too large")
+
+                # all checks done , let the client send the body
+                if self.headers.get('Expect','').lower() == '100-continue':
+                    self.wfile.write("%s 100 Continue\r\n\r\n" % (self.protocol_version))
+                    self.wfile.flush()
+
+                uploaddir = repo.statedir + "/uploads"
+                if not os.path.isdir(uploaddir):
+                    os.makedirs(uploaddir)
+                fd, temppkg = tempfile.mkstemp(dir=uploaddir, suffix='_' + filename)
+                md5 = hashlib.md5()
+                sha1 = hashlib.sha1()
+                sha256 = hashlib.sha256()
+                size = 0
+                try:
+                    with os.fdopen(fd,'wb') as f:
+                        for data in self.readBody(maxsize):
+                            size += len(data)
+                            md5.update(data)
+                            sha1.update(data)
+                            sha256.update(data)
+                            f.write(data)
+                    os.chmod(temppkg,0644)
+                except:
+                    os.remove(temppkg)
+                    raise
+                return temppkg, (size, md5.hexdigest(), sha1.hexdigest(), sha256.hexdigest())
+
+            def doPromote(self,params):
+                repo = self.repo
+                filename = params.get('filename',[''])[0]
+                frombranch = params.get('from',['test'])[0]
+                tobranch = params.get('to',['stable'])[0]
+                if frombranch not in repo.branches or tobranch not in repo.branches or frombranch == tobranch:
+                    self.send_error(400,"invalid branches")
+                    return
+                if not repo.nameformat.match(filename) or os.path.basename(filename) != filename:
+                    self.send_error(400,"unknown file name")
+                    return
+                if not repo.promotePackage(filename,frombranch,tobranch):
+                    self.send_error(404,"unable to promote %s from %s" % (filename,frombranch))
+                    return
+                self.sendJson({ 'filename' : filename, 'from' : frombranch, 'to' : tobranch, 'status' : 'published' })
+
+            def receiveBulk(self,bulkdir):
+                # unpack the .debs of a tar or multipart body into bulkdir .
+                # the body is capped at maxbulkfiles packages of the max size
+                repo = self.repo
+                maxsize = repo.maxuploadsize * 1024 * 1024
+                maxtotal = maxsize * repo.maxbulkfiles
+                if self.headers.get('Transfer-Encoding','').lower() != 'chunked':
+                    try:
+                        content_length = int(self.headers['Content-Length'])
+                    except (TypeError, ValueError):
+                        raise UploadError(411,"Content-Length required")
+                    if content_length > maxtotal:
+                        raise UploadError(413,"upload too large")
+
+                if self.headers.get('Expect','').lower() == '100-continue':
+                    self.wfile.write("%s 100 Continue\r\n\r\n" % (self.protocol_version))
+                    self.wfile.flush()
+
+                body = BodyReader(self.readBody(maxtotal))
+                ctype, pdict = cgi.parse_header(self.headers.get('Content-Type',''))
+                if ctype == 'multipart/form-data':
+                    class BulkForm(cgi.FieldStorage):
+                        # spool the parts in the repo , not the system temp dir
+                        def make_file(self,binary=None):
+                            return tempfile.TemporaryFile("w+b",dir=bulkdir)
+                    form = BulkForm(fp=body, headers=self.headers,
+                                    environ={ 'REQUEST_METHOD' : 'POST', 'CONTENT_TYPE' : self.headers['Content-Type'] })
+                    items = form.list or []
+                    files = [(item.filename, item.file) for item in items if item.filename]
+                else:
+                    try:
+                        tar = tarfile.open(fileobj=body, mode='r|*')
+                    except tarfile.TarError:
+                        raise UploadError(400,"expected a tar or multipart/form-data body")
+                    files = ((member.name, tar.extractfile(member)) for member in tar if member.isfile())
+
+                count = 0
+                for name, src in files:
+                    name = os.path.basename(name.replace('\\','/'))
+                    if not name.endswith('.deb') or name.startswith('.'):
+                        continue
+                    if count >= repo.maxbulkfiles:
+                        raise UploadError(413,"more than %d packages" % (repo.maxbulkfiles))
+                    size = 0
+                    with open(bulkdir + "/" + name,'wb') as f:
+                        while True:
+                            data = src.read(CHUNKSIZE)
+                            if not data:
+                                break
+                            size += len(data)
+                            if size > maxsize:
+                                raise UploadError(413,"%s too large" % (name))
+                            f.write(data)
+                    count += 1
+                return count
+
+            def doBulk(self,params):
+                repo = self.repo
+                branch = params.get('branch',['test'])[0]
+                if branch not in repo.branches:
+                    log.error("unknown branch : %s",branch)
+                    self.send_error(400,"unknown branch")
+                    return
+
+                uploaddir = repo.statedir + "/uploads"
+                if not os.path.isdir(uploaddir):
+                    os.makedirs(uploaddir)
+                bulkdir = tempfile.mkdtemp(dir=uploaddir, prefix='bulk')
+                try:
+                    try:
+                        with repo.metrics.timed('bulk.receive'):
+                            count = self.receiveBulk(bulkdir)
+                    except UploadError as e:
+                        log.error("bulk upload failed : %s",e.message)
+                        self.send_error(e.code,e.message)
+                        return
+                    log.info("bulk upload of %d packages to %s", count, branch)
+                    with repo.metrics.timed('bulk.process'):
+                        results = repo.processUploads(bulkdir,branch,move=True,replace=False)
+                finally:
+                    shutil.rmtree(bulkdir,True)
+                self.sendJson({ 'branch' : branch, 'files' : results })
+
             def do_POST(self):                
+                repo = self.repo
                 params=parse_qs(urlparse(self.path).query)
                 print params
 
+                if urlparse(self.path).path == '/promote':
+                    self.doPromote(params)
+                    return
+
+                if urlparse(self.path).path == '/bulk':
+                    self.doBulk(params)
+                    return
+
                 branchlist=params.get('branch',[])
                 branch = branchlist[0] if len(branchlist)>0 else 'test'
                 if branch not in repo.branches:
-                    branch='test'
+                    log.error("unknown branch : %s",branch)
+                    self.send_error(400,"unknown branch")
+                    return;
                     
                 files=params.get('filename',[])
                 filename = files[0] if len(files)>0 else ''
                 match = repo.nameformat.match(filename)
-                if not match:
+                if not match or os.path.basename(filename) != filename:
                     log.error("unknown file format : %s",filename)
                     self.send_error(400,"unknown file name")
                     return;
@@ -236,50 +2511,75 @@ class PackageRepo:
                     self.send_error(400,"pkg already exists")
                     return;
 
-                content_length = int(self.headers['Content-Length'])
-                filedata = self.rfile.read(content_length)
-                #print filedata
-                
-                # store it in a temp file
-                tempdir = tempfile.mkdtemp();
-                temppkg= tempdir + "/" + filename
-                with open(temppkg,'w') as f:
-                    f.write(filedata)
-                    f.close()
+                try:
+                    with repo.metrics.timed('upload.receive'):
+                        temppkg, digests = self.receiveUpload(filename)
+                    repo.metrics.observe('pkgrepo_upload_bytes',digests[0])
+                except UploadError as e:
+                    log.error("upload of %s failed : %s",filename,e.message)
+                    self.send_error(e.code,e.message)
+                    return
                     
                 try :
                     # now verify the file .
-                    execcmd="lintian -C deb-format " + temppkg + " 2>/dev/null"
-                    log.info(execcmd)
-                    ret=os.system(execcmd)
-                    if ret != 0 :
-                        log.error("pkg not in debian format %s" , filename)
-                        self.send_error(400,"invalid deb format")
+                    try:
+                        with repo.metrics.timed('upload.validate'):
+                            control = DebArchive(temppkg).validate(filename)
+                    except DEBERRORS as e:
+                        log.error("pkg not in debian format %s : %s" , filename, e)
+                        self.send_error(400,"invalid deb format : %s" % (e))
                         return
-                    shutil.copyfile(temppkg,repo.getPackageLocation(filename,branch))
+                    pkgpath = repo.getPackageLocation(filename,branch)
+                    with repo.lock:
+                        # another upload may have won the race since the check above
+                        if repo.pkgExists(filename,branch) or repo.publisher.isPending(pkgpath):
+                            log.error("pkg already exists : %s",filename)
+                            self.send_error(400,"pkg already exists")
+                            return
+                        uploadid = repo.publisher.submit(temppkg,pkgpath,digests,control)
+                        # the publisher owns the staged file now
+                        temppkg = None
                 finally:
-                    os.remove(temppkg)
-                    pass
-                    
-                repo.doneUploads()
+                    if temppkg != None and os.path.exists(temppkg):
+                        os.remove(temppkg)
 
-                self.sendOk()
+                waitlist = params.get('wait',[])
+                if len(waitlist) > 0 and waitlist[0] not in ['0','no','false']:
+                    try:
+                        status = repo.publisher.wait(uploadid)
+                    except UploadError as e:
+                        log.error("upload of %s : %s",filename,e.message)
+                        self.send_error(e.code,e.message)
+                        return
+                    self.sendJson(status)
+                else:
+                    self.sendJson(repo.publisher.getStatus(uploadid),202)
 
         # -- end of class ServerHandler
 
         os.chdir(self.repodir)
         ServerHandler.repo=self
-        httpd = SocketServer.TCPServer(("", port), ServerHandler,bind_and_activate=False)
-        httpd.allow_reuse_address = True
-        log.info("serving at port %d",port)
+        self.loadCatalogue()
+        if self.indexcachesize > 0:
+            self.indexcache = IndexCache(self.indexcachesize * 1024 * 1024)
+        # fork the compression workers before any threads exist
+        self.getPool()
+        self.publisher = Publisher(self,self.publishdelay)
+        self.publisher.start()
+        httpd = RepoHTTPServer(("", port), ServerHandler,bind_and_activate=False)
+        httpd.poolsize = threads
+        httpd.request_queue_size = backlog
+        log.info("serving at port %d with %d threads",port,threads)
         try :
             httpd.server_bind()
             httpd.server_activate()
+            httpd.startWorkers()
             httpd.serve_forever()
         except KeyboardInterrupt:
             pass;
         finally:
             httpd.server_close()
+            self.close()
             
     
 if __name__ == "__main__":
@@ -290,7 +2590,22 @@ if __name__ == "__main__":
     parser.add_argument('--setup', action="store_true" , help = "initialize a repo")
     parser.add_argument('--server', action="store_true", help = "run http server")
     parser.add_argument('--remove', default = None , help = "delete a package")
+    parser.add_argument('--import', dest = 'importdir', default = None , help = "add all the .debs in a dir")
+    parser.add_argument('-b','--branch', default = 'test' , help = "branch to import into")
+    parser.add_argument('--retain', nargs='+', default = None , metavar='GLOB', help = "apply a retention policy to the matching package names of a branch")
+    parser.add_argument('--keep', type=int, default = None , help = "retain : versions of each package to always keep")
+    parser.add_argument('--max-age', dest = 'maxage', type=float, default = None , help = "retain : remove the other versions older than this many days")
+    parser.add_argument('-n','--dry-run', dest = 'dryrun', action="store_true", help = "retain : only list what would be removed")
+    parser.add_argument('--rebuild-db', dest = 'rebuilddb', action="store_true", help = "rebuild the package db from the branch dirs and reindex")
+    parser.add_argument('--sync', default = None , metavar='URL', help = "mirror the branches of another repo")
+    parser.add_argument('--dist', default = None , help = "sync : distname of the remote repo , the local one by default")
+    parser.add_argument('--connections', type=int, default = 8 , help = "sync : parallel downloads")
+    parser.add_argument('--promote', default = None , help = "move a package to another branch")
+    parser.add_argument('--from', dest = 'frombranch', default = 'test' , help = "branch to promote from")
+    parser.add_argument('--to', dest = 'tobranch', default = 'stable' , help = "branch to promote to")
     parser.add_argument('-p','--port', type=int, help = "server port" , default=8000)
+    parser.add_argument('-t','--threads', type=int, help = "server worker threads" , default=16)
+    parser.add_argument('--backlog', type=int, help = "server listen backlog" , default=64)
 
     args = parser.parse_args()
 
@@ -300,7 +2615,7 @@ if __name__ == "__main__":
         sys.exit(0)
 
 
-    if not (args.setup or args.remove or args.server) :
+    if not (args.setup or args.rebuilddb or args.remove or args.importdir or args.retain or args.sync or args.promote or args.server) :
         log.error("no action specified ..")
         parser.print_usage()
         sys.exit(0)
@@ -313,8 +2628,52 @@ if __name__ == "__main__":
     if args.setup:
         repo.setup()
 
+    if args.rebuilddb:
+        repo.rebuildDB()
+        repo.doneUploads()
+        repo.close()
+
     if args.remove:
         repo.removePackage(args.remove)
 
+    if args.importdir:
+        if args.branch not in repo.branches:
+            log.error("unknown branch : %s", args.branch)
+            sys.exit(1)
+        results = repo.processUploads(args.importdir,args.branch)
+        for result in results:
+            print "%-10s %s %s" % (result['status'], result['filename'], result.get('error',''))
+        repo.close()
+
+    if args.retain:
+        if args.branch not in repo.branches:
+            log.error("unknown branch : %s", args.branch)
+            sys.exit(1)
+        if args.keep == None and args.maxage == None:
+            log.error("retain needs --keep and/or --max-age")
+            sys.exit(1)
+        expired = repo.retainPackages(args.branch,args.retain,args.keep,args.maxage,args.dryrun)
+        for path, version, age in expired:
+            print "%-10s %s %s (%.1f days)" % ('expired' if args.dryrun else 'removed', repo.getFilename(path), version, age)
+        repo.close()
+
+    if args.sync:
+        try:
+            result = Mirror(repo,args.sync,args.dist,args.connections).run()
+        except (IOError, ValueError, httplib.HTTPException) as e:
+            log.error("sync from %s failed : %s", args.sync, e)
+            sys.exit(1)
+        finally:
+            repo.close()
+        print "added %d (%d downloaded) , removed %d" % (result['added'], result['downloaded'], result['removed'])
+        for filename in result['failed']:
+            print "%-10s %s" % ('failed', filename)
+        if len(result['failed']) > 0:
+            sys.exit(1)
+
+    if args.promote:
+        if not repo.promotePackage(args.promote,args.frombranch,args.tobranch):
+            sys.exit(1)
+
     if args.server:
-        repo.server(args.port)
+        repo.server(args.port,args.threads,args.backlog)